@@ -10,9 +10,10 @@ from torch import optim, nn
 from torch.backends import cudnn
 from torch.utils.data import DataLoader
 import torch.utils.data
-from metric import psnr, ssim
+from metric import MetricAccumulator, EvalWorker
+from utils import CheckpointWriter
 from loss import SSIM, FA, ContrastLoss
-from data import RESIDE_Dataset, TestDataset, CLIP_loader
+from data import RESIDE_Dataset, TestDataset, CLIP_loader, TeacherWorker, pad_collate, prepare_batch
 from model import Teacher, Student
 from CLIP import L_clip_from_feature
 from collections import OrderedDict
@@ -21,6 +22,24 @@ from option.EMA import opt
 start_time = time.time()
 steps = opt.iters_per_epoch * opt.epochs
 T = steps
+amp_dtype = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[opt.amp]
+# Only fp16 needs loss scaling; torch.cuda.amp.GradScaler also exists in the torch 2.2 of the README.
+scaler = torch.cuda.amp.GradScaler() if opt.amp == 'fp16' else None
+
+
+def autocast():
+    # FA, SSIM and psnr cast their inputs back to fp32, the rest of the forward runs in amp_dtype.
+    return torch.autocast(device_type=opt.device, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+
+def optimizer_step(loss, optim):
+    if scaler is None:
+        loss.backward()
+        optim.step()
+    else:
+        scaler.scale(loss).backward()
+        scaler.step(optim)
+        scaler.update()
 
 
 def lr_schedule_cosdecay(t, T, init_lr=opt.start_lr, end_lr=opt.end_lr):
@@ -68,9 +87,11 @@ def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterio
     psnrs = []
 
     loader_train_iter_1 = iter(loader_train_1)
+    checkpoint_writer = CheckpointWriter()
     alpha = 0.95
     save_count = 0
 
+    images, train_start = 0, time.time()
     for step in range(start_step + 1, steps + 1):
         teacher_net.eval()
         student_net.train()
@@ -80,25 +101,33 @@ def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterio
             for param_group in optim.param_groups:
                 param_group["lr"] = lr
 
-        x = next(loader_train_iter_1)
-        x = x.to(opt.device)
-
-        with torch.no_grad():
-            teacher_output = teacher_net(x)
-        student_out = student_net(x)
-
-        loss_L1_r = 0
-        loss_Clip = 0
-
-        if opt.w_loss_L1_r > 0:
-            loss_L1_r = criterion[0](student_out[0], teacher_output[0])
-        if opt.w_loss_Clip > 0:
-            loss_Clip = criterion[1](student_out[0], text_features)
-
-        loss = opt.w_loss_L1_r * loss_L1_r + opt.w_loss_Clip * loss_Clip
-        loss.backward()
-        optim.step()
+        if isinstance(loader_train_1, TeacherWorker):
+            x, teacher_output = next(loader_train_iter_1)
+            x = x.to(opt.device)
+            teacher_output = teacher_output.to(opt.device)
+        else:
+            x = next(loader_train_iter_1)
+            x = x.to(opt.device)
+            if opt.batch_aug:
+                x = prepare_batch(x)
+            with torch.no_grad(), autocast():
+                teacher_output = teacher_net(x, features=False)
+
+        with autocast():
+            student_out = student_net(x, features=False)
+
+            loss_L1_r = 0
+            loss_Clip = 0
+
+            if opt.w_loss_L1_r > 0:
+                loss_L1_r = criterion[0](student_out, teacher_output)
+            if opt.w_loss_Clip > 0:
+                loss_Clip = criterion[1](student_out, text_features)
+
+            loss = opt.w_loss_L1_r * loss_L1_r + opt.w_loss_Clip * loss_Clip
+        optimizer_step(loss, optim)
         optim.zero_grad()
+        images += x.size(0)
         losses.append(loss.item())
         loss_log_tmp['L1_r'].append(loss_L1_r.item())
         loss_log_tmp['Clip'].append(loss_Clip.item())
@@ -121,57 +150,65 @@ def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterio
                         5 * len(loader_train_1))
             else:
                 epoch = int(step / opt.iters_per_epoch)
-            with torch.no_grad():
-                ssim_eval, psnr_eval = test(student_net, loader_test)
-
-            log = f'\nstep :{step} | epoch: {epoch} | ssim:{ssim_eval:.4f}| psnr:{psnr_eval:.4f} | lr:{lr:.12f}'
-            print(log)
-            with open(os.path.join(opt.saved_data_dir, 'log.txt'), 'a') as f:
-                f.write(log + '\n')
-
-            ssims.append(ssim_eval)
-            psnrs.append(psnr_eval)
-            psnr_log.append(psnr_eval)
+            throughput = images / (time.time() - train_start)
+            extra = f'lr:{lr:.12f} | amp:{opt.amp} | {throughput:.1f} img/s'
             state_dict = student_net.state_dict()
-            if 'module' in list(state_dict.keys())[0]:
-                from collections import OrderedDict
-                new_state_dict = OrderedDict()
-                for k, v in state_dict.items():
-                    name = k.replace('module.', '')
-                    new_state_dict[name] = v
-                state_dict = new_state_dict
-
-            if psnr_eval > max_psnr:
-                max_ssim = max(max_ssim, ssim_eval)
-                max_psnr = max(max_psnr, psnr_eval)
-                print(
-                    f'model saved at step :{step}| epoch: {epoch} | max_psnr:{max_psnr:.4f}| max_ssim:{max_ssim:.4f}')
-                saved_best_model_path = os.path.join(opt.saved_model_dir, 'best.pth')
-                torch.save(state_dict, saved_best_model_path)
-
-            saved_single_model_path = os.path.join(opt.saved_model_dir, str(epoch) + '.pth')
-            torch.save(state_dict, saved_single_model_path)
+            saved_paths = [os.path.join(opt.saved_model_dir, str(epoch) + '.pth')]
+
+            if isinstance(loader_test, EvalWorker):
+                # Logged and compared with best.pth by the worker; earlier results are collected here.
+                loader_test.submit(step, epoch, extra, state_dict)
+                results = loader_test.poll()
+            else:
+                with torch.no_grad():
+                    ssim_eval, psnr_eval = test(student_net, loader_test)
+
+                log = f'\nstep :{step} | epoch: {epoch} | ssim:{ssim_eval:.4f}| psnr:{psnr_eval:.4f} | {extra}'
+                print(log)
+                with open(os.path.join(opt.saved_data_dir, 'log.txt'), 'a') as f:
+                    f.write(log + '\n')
+
+                if psnr_eval > max_psnr:
+                    max_ssim = max(max_ssim, ssim_eval)
+                    max_psnr = max(max_psnr, psnr_eval)
+                    print(
+                        f'model saved at step :{step}| epoch: {epoch} | max_psnr:{max_psnr:.4f}| max_ssim:{max_ssim:.4f}')
+                    saved_paths.append(os.path.join(opt.saved_model_dir, 'best.pth'))
+                results = [(step, ssim_eval, psnr_eval)]
+
+            for _, ssim_eval, psnr_eval in results:
+                ssims.append(ssim_eval)
+                psnrs.append(psnr_eval)
+                psnr_log.append(psnr_eval)
+
+            checkpoint_writer.save(state_dict, *saved_paths)
             save_count += 1
 
             if save_count % 1 == 0:
-                update_ema_variables(student_net, teacher_net, alpha)
+                if isinstance(loader_train_1, TeacherWorker):
+                    with loader_train_1.update():
+                        update_ema_variables(student_net, teacher_net, alpha)
+                else:
+                    update_ema_variables(student_net, teacher_net, alpha)
             if save_count % 1 == 0:
-                teacher_state_dict = teacher_net.state_dict()
-                if 'module' in list(teacher_state_dict.keys())[0]:
-                    from collections import OrderedDict
-                    new_teacher_state_dict = OrderedDict()
-                    for k, v in teacher_state_dict.items():
-                        name = k.replace('module.', '')
-                        new_teacher_state_dict[name] = v
-                    teacher_state_dict = new_teacher_state_dict
                 saved_teacher_model_path = os.path.join(opt.saved_model_dir, 'teacher_' + str(epoch) + '.pth')
-                torch.save(teacher_state_dict, saved_teacher_model_path)
+                checkpoint_writer.save(teacher_net.state_dict(), saved_teacher_model_path)
 
                 print(f'Teacher model updated and saved at epoch: {epoch}, step: {step}')
 
             loader_train_iter_1 = iter(loader_train_1)
             np.save(os.path.join(opt.saved_data_dir, 'ssims.npy'), ssims)
             np.save(os.path.join(opt.saved_data_dir, 'psnrs.npy'), psnrs)
+            images, train_start = 0, time.time()
+
+    if isinstance(loader_test, EvalWorker):
+        for _, ssim_eval, psnr_eval in loader_test.close():
+            ssims.append(ssim_eval)
+            psnrs.append(psnr_eval)
+            psnr_log.append(psnr_eval)
+        np.save(os.path.join(opt.saved_data_dir, 'ssims.npy'), ssims)
+        np.save(os.path.join(opt.saved_data_dir, 'psnrs.npy'), psnrs)
+    checkpoint_writer.close()
 
 
 def pad_img(x, patch_size):
@@ -185,23 +222,22 @@ def pad_img(x, patch_size):
 def test(net, loader_test):
     net.eval()
     torch.cuda.empty_cache()
-    ssims = []
-    psnrs = []
+    metrics = MetricAccumulator()
 
-    for i, (inputs, targets, hazy_name) in enumerate(loader_test):
+    for i, (inputs, targets, masks, hazy_name) in enumerate(loader_test):
         inputs = inputs.to(opt.device)
         targets = targets.to(opt.device)
+        masks = masks.to(opt.device)
         with torch.no_grad():
             H, W = inputs.shape[2:]
             inputs = pad_img(inputs, 4)
-            pred = net(inputs)[0].clamp(0, 1)
+            with autocast():
+                pred = net(inputs, features=False)
+            pred = pred.float().clamp(0, 1)
             pred = pred[:, :, :H, :W]
-        ssim_tmp = ssim(pred, targets).item()
-        psnr_tmp = psnr(pred, targets)
-        ssims.append(ssim_tmp)
-        psnrs.append(psnr_tmp)
+        metrics.update(pred, targets, masks)
 
-    return np.mean(ssims), np.mean(psnrs)
+    return metrics.compute()
 
 
 def set_seed_torch(seed=2018):
@@ -238,21 +274,32 @@ if __name__ == "__main__":
     res_model.eval()
 
     train_dir_1 = './data/real_foggy'
-    train_set_1 = CLIP_loader(train_dir_1, True, 256)
+    # The worker runs the teacher on the dataset crops, before any batch augmentation.
+    assert not (opt.batch_aug and opt.teacher_worker), '--batch_aug does not work with --teacher_worker'
+    train_set_1 = CLIP_loader(train_dir_1, True, 256, raw=opt.batch_aug)
 
     test_dir = './data/THaze/test'
     test_set = TestDataset(os.path.join(test_dir, 'hazy'), os.path.join(test_dir, 'clear'))
 
-    loader_train_1 = DataLoader(dataset=train_set_1, batch_size=24, shuffle=True, num_workers=8)
-    loader_test = DataLoader(dataset=test_set, batch_size=1, shuffle=False, num_workers=1)
+    loader_kwargs = dict(batch_size=24, shuffle=True, num_workers=8)
+    loader_train_1 = DataLoader(dataset=train_set_1, **loader_kwargs)
+    loader_test = DataLoader(dataset=test_set, batch_size=opt.test_batch_size, shuffle=False, num_workers=1,
+                             collate_fn=pad_collate)
 
     teacher_net = Student()
     teacher_net = teacher_net.to(opt.device)
     teacher_net.load_state_dict(torch.load('./model/Student_model/Student.pth', map_location=torch.device("cpu")))
     teacher_net.eval()
+    if opt.teacher_worker:
+        # The EMA updates below write into the teacher weights shared with the worker.
+        loader_train_1 = TeacherWorker(teacher_net, train_set_1, loader_kwargs, opt.device, False, opt.teacher_queue,
+                                       opt.teacher_threads, amp_dtype)
 
     student_net = Student()
     student_net = student_net.to(opt.device)
+    if opt.async_eval:
+        loader_test = EvalWorker(student_net, test_set, opt.test_batch_size, opt.device, opt.saved_model_dir,
+                                 opt.saved_data_dir, amp_dtype)
     student_net.load_state_dict(torch.load('./model/Student_model/Student.pth', map_location=torch.device("cpu")))
 
     if opt.device == 'cuda':
@@ -261,6 +308,7 @@ if __name__ == "__main__":
 
     pytorch_total_params = sum(p.numel() for p in student_net.parameters() if p.requires_grad)
     print("Total_params: ==> {}".format(pytorch_total_params))
+    print(f"amp: {opt.amp}")
     print("------------------------------------------------------------------")
 
     criterion = []
@@ -271,4 +319,8 @@ if __name__ == "__main__":
                            betas=(0.9, 0.999),
                            eps=1e-08)
     optimizer.zero_grad()
-    train(teacher_net, student_net, loader_train_1, loader_test, optimizer, criterion)
+    try:
+        train(teacher_net, student_net, loader_train_1, loader_test, optimizer, criterion)
+    finally:
+        if isinstance(loader_train_1, TeacherWorker):
+            loader_train_1.close()
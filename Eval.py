@@ -1,9 +1,14 @@
 import os
 import glob
+import time
+import queue
+import threading
 import torch
 import torchvision
+import torch.nn.functional as F
 from PIL import Image
 from tqdm import tqdm
+from concurrent.futures import ThreadPoolExecutor
 from model import Teacher, Student, Student_x
 from torchvision.transforms import Compose, ToTensor, Normalize, Resize, InterpolationMode
 
@@ -16,23 +21,180 @@ from torchvision.transforms import Compose, ToTensor, Normalize, Resize, Interpo
 MODEL_PATH = './model/EMA_model/EMA_r.pth'
 OUTPUT_FOLDER = './outputs/EMA'
 
+# Images whose sizes round down to the same multiple of 16 are dehazed together, BATCH_SIZE at a time.
+# BATCH_SIZE = 1 keeps the original one-image-at-a-time loop.
+BATCH_SIZE = 8
+
+# TILE_SIZE > 0 dehazes every image tile by tile instead, so peak memory depends on the tile size and not on the
+# image size. Tiles overlap by TILE_OVERLAP pixels, are blended with a feathered window and run TILE_BATCH at a time.
+# Both sizes must be multiples of 16.
+TILE_SIZE = 0
+TILE_OVERLAP = 64
+TILE_BATCH = 4
+
+# PIPELINE = True overlaps image decoding, inference and PNG encoding: DECODE_WORKERS threads decode ahead of the
+# model through a queue of QUEUE_DEPTH images and ENCODE_WORKERS threads save the outputs.
+PIPELINE = False
+DECODE_WORKERS = 4
+ENCODE_WORKERS = 4
+QUEUE_DEPTH = 16
+
+transform = Compose([
+    ToTensor(),
+    Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))])
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
 
 def dehaze(model, image_path, folder):
     haze = transform(Image.open(image_path).convert("RGB")).unsqueeze(0).to(device)
     h, w = haze.shape[2], haze.shape[3]
     haze = Resize((h // 16 * 16, w // 16 * 16), interpolation=InterpolationMode.BICUBIC, antialias=True)(haze)
-    out = model(haze)[0].squeeze(0)
+    out = model(haze, features=False).squeeze(0)
     out = Resize((h, w), interpolation=InterpolationMode.BICUBIC, antialias=True)(out)
     torchvision.utils.save_image(out, os.path.join(folder, os.path.basename(image_path)))
 
 
-if __name__ == '__main__':
+def pad_img(x, patch_size):
+    _, _, h, w = x.size()
+    mod_pad_h = (patch_size - h % patch_size) % patch_size
+    mod_pad_w = (patch_size - w % patch_size) % patch_size
+    x = F.pad(x, (0, mod_pad_w, 0, mod_pad_h), 'reflect')
+    return x
+
+
+def tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    starts.append(length - tile_size)
+    return starts
+
+
+def feather_window(tile_size, overlap, first, last, device):
+    # Linear ramp over the overlap on every side that touches another tile, flat on the image border.
+    window = torch.ones(tile_size, device=device)
+    pos = torch.arange(tile_size, device=device, dtype=torch.float32)
+    if not first:
+        window = torch.minimum(window, (pos + 1) / (overlap + 1))
+    if not last:
+        window = torch.minimum(window, (tile_size - pos) / (overlap + 1))
+    return window
+
+
+def dehaze_tiled(model, haze, tile_size=512, overlap=64, batch_size=4):
+    if tile_size % 16 or overlap % 16 or overlap >= tile_size:
+        raise ValueError(f'tile size ({tile_size}) and overlap ({overlap}) must be multiples of 16 with overlap < tile size')
+    _, _, h, w = haze.shape
+    haze = pad_img(haze, 16)
+    H, W = haze.shape[2], haze.shape[3]
+    tile_h, tile_w = min(tile_size, H), min(tile_size, W)
+    ys = tile_starts(H, tile_h, overlap)
+    xs = tile_starts(W, tile_w, overlap)
+
+    out = haze.new_zeros(haze.shape[0], 3, H, W)
+    weight = haze.new_zeros(1, 1, H, W)
+    tiles = [(y, x) for y in ys for x in xs]
+    for i in range(0, len(tiles), batch_size):
+        chunk = tiles[i:i + batch_size]
+        batch = torch.cat([haze[:, :, y:y + tile_h, x:x + tile_w] for y, x in chunk])
+        preds = model(batch, features=False).split(haze.shape[0])
+        for (y, x), pred in zip(chunk, preds):
+            window = feather_window(tile_h, overlap, y == ys[0], y == ys[-1], haze.device)[:, None] * \
+                     feather_window(tile_w, overlap, x == xs[0], x == xs[-1], haze.device)[None, :]
+            out[:, :, y:y + tile_h, x:x + tile_w] += pred * window
+            weight[:, :, y:y + tile_h, x:x + tile_w] += window
+    return (out / weight)[:, :, :h, :w]
+
+
+def dehaze_large(model, image_path, folder):
+    haze = transform(Image.open(image_path).convert("RGB")).unsqueeze(0).to(device)
+    out = dehaze_tiled(model, haze, TILE_SIZE, TILE_OVERLAP, TILE_BATCH).squeeze(0)
+    torchvision.utils.save_image(out, os.path.join(folder, os.path.basename(image_path)))
+
 
-    transform = Compose([
-        ToTensor(),
-        Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))])
+def bucket_images(image_paths):
+    # Only the image header is read here, the pixels are decoded later by dehaze_batch.
+    buckets = {}
+    for image_path in image_paths:
+        with Image.open(image_path) as img:
+            w, h = img.size
+        buckets.setdefault((h // 16 * 16, w // 16 * 16), []).append(image_path)
+    return buckets
 
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+def load_image(image_path):
+    haze = transform(Image.open(image_path).convert("RGB"))
+    h, w = haze.shape[1], haze.shape[2]
+    haze = Resize((h // 16 * 16, w // 16 * 16), interpolation=InterpolationMode.BICUBIC, antialias=True)(haze)
+    return image_path, haze, (h, w)
+
+
+def save_output(out, size, image_path, folder):
+    out = Resize(size, interpolation=InterpolationMode.BICUBIC, antialias=True)(out)
+    torchvision.utils.save_image(out, os.path.join(folder, os.path.basename(image_path)))
+
+
+def dehaze_batch(model, image_paths, folder):
+    _, hazes, sizes = zip(*[load_image(image_path) for image_path in image_paths])
+    haze = torch.stack(hazes).to(device)
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    outs = model(haze, features=False)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    for image_path, out, size in zip(image_paths, outs, sizes):
+        save_output(out, size, image_path, folder)
+    return elapsed
+
+
+def dehaze_pipeline(model, image_paths, folder, batch_size=BATCH_SIZE, decode_workers=DECODE_WORKERS,
+                    encode_workers=ENCODE_WORKERS, queue_depth=QUEUE_DEPTH):
+    # Decoding, the forward pass and encoding overlap: a thread pool decodes the next images into a bounded queue
+    # while the model runs, and the outputs are handed to a second pool that resizes and saves them. At most
+    # queue_depth decoded inputs and queue_depth pending outputs are alive at any time.
+    decoded = queue.Queue(maxsize=queue_depth)
+    pending = threading.Semaphore(queue_depth)
+    writes = []
+
+    def feed():
+        with ThreadPoolExecutor(decode_workers) as decoders:
+            for image_path in image_paths:
+                decoded.put(decoders.submit(load_image, image_path))
+        decoded.put(None)
+
+    def run(batch):
+        paths, hazes, sizes = zip(*batch)
+        outs = model(torch.stack(hazes).to(device), features=False).cpu()
+        for image_path, out, size in zip(paths, outs, sizes):
+            pending.acquire()
+            write = encoders.submit(save_output, out, size, image_path, folder)
+            write.add_done_callback(lambda _: pending.release())
+            writes.append(write)
+
+    threading.Thread(target=feed, daemon=True).start()
+    with ThreadPoolExecutor(encode_workers) as encoders:
+        batch = []
+        while True:
+            item = decoded.get()
+            if item is None:
+                break
+            item = item.result()
+            if batch and (len(batch) == batch_size or batch[0][1].shape != item[1].shape):
+                run(batch)
+                batch = []
+            batch.append(item)
+        if batch:
+            run(batch)
+    for write in writes:
+        write.result()
+
+
+if __name__ == '__main__':
 
     # model = Teacher().to(device)
     # model = Student().to(device)
@@ -40,6 +202,8 @@ if __name__ == '__main__':
 
     model.load_state_dict(torch.load(MODEL_PATH, map_location=device))
     model.eval()
+    if isinstance(model, (Teacher, Student)):
+        model.switch_to_deploy()
 
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
@@ -49,5 +213,22 @@ if __name__ == '__main__':
 
     bar_format = "{l_bar}{bar}| {n_fmt}/{total_fmt} | Elapsed: {elapsed} | Rate: {rate_fmt} items/sec"
     with torch.no_grad():
-        for image in tqdm(images, bar_format=bar_format, desc="Models are struggling to get out of the fog 😊 :"):
-            dehaze(model, image, OUTPUT_FOLDER)
+        if TILE_SIZE > 0:
+            for image in tqdm(images, bar_format=bar_format, desc="Models are struggling to get out of the fog 😊 :"):
+                dehaze_large(model, image, OUTPUT_FOLDER)
+        elif PIPELINE:
+            start = time.perf_counter()
+            dehaze_pipeline(model, [p for paths in bucket_images(images).values() for p in paths], OUTPUT_FOLDER)
+            print(f'images: {len(images)} | {len(images) / (time.perf_counter() - start):.2f} images/s')
+        elif BATCH_SIZE > 1:
+            for (h, w), paths in bucket_images(images).items():
+                model_time = 0
+                start = time.perf_counter()
+                for i in tqdm(range(0, len(paths), BATCH_SIZE), bar_format=bar_format, desc=f"Bucket {h}x{w} 😊 :"):
+                    model_time += dehaze_batch(model, paths[i:i + BATCH_SIZE], OUTPUT_FOLDER)
+                total_time = time.perf_counter() - start
+                print(f'bucket: {h}x{w} | images: {len(paths)} | batch_size: {BATCH_SIZE} | '
+                      f'model: {len(paths) / model_time:.2f} images/s | total: {len(paths) / total_time:.2f} images/s')
+        else:
+            for image in tqdm(images, bar_format=bar_format, desc="Models are struggling to get out of the fog 😊 :"):
+                dehaze(model, image, OUTPUT_FOLDER)
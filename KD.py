@@ -10,9 +10,11 @@ from torch import optim, nn
 from torch.backends import cudnn
 from torch.utils.data import DataLoader
 import torch.utils.data
-from metric import psnr, ssim
+from metric import MetricAccumulator, EvalWorker
+from utils import CheckpointWriter, rng_state, set_rng_state, load_training_state
 from loss import SSIM, FA, ContrastLoss
-from data import RESIDE_Dataset, TestDataset, CLIP_loader
+from data import RESIDE_Dataset, TestDataset, CLIP_loader, TeacherCacheDataset, TeacherWorker, PackedDataset, \
+    pad_collate, prepare_batch
 from model import Teacher, Student
 from collections import OrderedDict
 from option.KD import opt
@@ -20,6 +22,24 @@ from option.KD import opt
 start_time = time.time()
 steps = opt.iters_per_epoch * opt.epochs
 T = steps
+amp_dtype = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[opt.amp]
+# Only fp16 needs loss scaling; torch.cuda.amp.GradScaler also exists in the torch 2.2 of the README.
+scaler = torch.cuda.amp.GradScaler() if opt.amp == 'fp16' else None
+
+
+def autocast():
+    # FA, SSIM and psnr cast their inputs back to fp32, the rest of the forward runs in amp_dtype.
+    return torch.autocast(device_type=opt.device, dtype=amp_dtype, enabled=amp_dtype is not None)
+
+
+def optimizer_step(loss, optim):
+    if scaler is None:
+        loss.backward()
+        optim.step()
+    else:
+        scaler.scale(loss).backward()
+        scaler.step(optim)
+        scaler.update()
 
 
 def lr_schedule_cosdecay(t, T, init_lr=opt.start_lr, end_lr=opt.end_lr):
@@ -27,7 +47,7 @@ def lr_schedule_cosdecay(t, T, init_lr=opt.start_lr, end_lr=opt.end_lr):
     return lr
 
 
-def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterion):
+def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterion, resume=None):
     losses = []
     loss_log = {'FA': [], 'L1': [], 'SSIM': [], 'Cr': [], 'total': []}
     loss_log_tmp = {'FA': [], 'L1': [], 'SSIM': [], 'Cr': [], 'total': []}
@@ -38,11 +58,28 @@ def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterio
     max_psnr = 0
     ssims = []
     psnrs = []
+    if resume is not None:
+        start_step = resume['step']
+        max_ssim, max_psnr = resume['max_ssim'], resume['max_psnr']
+        ssims, psnrs, psnr_log, losses = resume['ssims'], resume['psnrs'], resume['psnr_log'], resume['losses']
+        loss_log, loss_log_tmp = resume['loss_log'], resume['loss_log_tmp']
+        if scaler is not None:
+            # A disabled scaler saves an empty state: the resumed run did not use fp16.
+            if resume['scaler']:
+                scaler.load_state_dict(resume['scaler'])
+            else:
+                print('warning: the resumed run did not use --amp fp16, starting with a fresh GradScaler')
+        # Restored last, so the shuffling and augmentation from here on only depend on the saved state.
+        set_rng_state(resume['rng'])
+        print(f'resumed at step {start_step}/{steps}')
 
     loader_train_iter_1 = iter(loader_train_1)
+    checkpoint_writer = CheckpointWriter()
 
+    images, train_start = 0, time.time()
     for step in range(start_step + 1, steps + 1):
-        teacher_net.eval()
+        if teacher_net is not None:
+            teacher_net.eval()
         student_net.train()
         lr = opt.start_lr
         if not opt.no_lr_sche:
@@ -50,32 +87,43 @@ def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterio
             for param_group in optim.param_groups:
                 param_group["lr"] = lr
 
-        x, y = next(loader_train_iter_1)
-        x = x.to(opt.device)
-        y = y.to(opt.device)
-
-        with torch.no_grad():
-            teacher_output = teacher_net(x)
-        student_out = student_net(x)
-
-        loss_FA = 0
-        loss_L1 = 0
-        loss_SSIM = 0
-        loss_Cr = 0
-
-        if opt.w_loss_FA > 0:
-            loss_FA = criterion[0](student_out[1], teacher_output[1])
-        if opt.w_loss_L1 > 0:
-            loss_L1 = criterion[1](student_out[0], y)
-        if opt.w_loss_SSIM > 0:
-            loss_SSIM = (1 - criterion[2](student_out[0], y))
-        if opt.w_loss_Cr > 0:
-            loss_Cr = criterion[3](student_out[0], y, x)
-
-        loss = opt.w_loss_FA * loss_FA + opt.w_loss_L1 * loss_L1 + opt.w_loss_SSIM * loss_SSIM + opt.w_loss_Cr * loss_Cr
-        loss.backward()
-        optim.step()
+        try:
+            batch = next(loader_train_iter_1)
+        except StopIteration:
+            # Only after resuming in the middle of an epoch; otherwise the epoch boundary below restarts the iterator.
+            loader_train_iter_1 = iter(loader_train_1)
+            batch = next(loader_train_iter_1)
+        x = batch[0].to(opt.device)
+        y = batch[1].to(opt.device)
+        if opt.batch_aug:
+            x, y = prepare_batch(x, y)
+
+        with autocast():
+            if teacher_net is None:
+                teacher_output = batch[2].to(opt.device).float(), [f.to(opt.device).float() for f in batch[3]]
+            else:
+                with torch.no_grad():
+                    teacher_output = teacher_net(x)
+            student_out = student_net(x)
+
+            loss_FA = 0
+            loss_L1 = 0
+            loss_SSIM = 0
+            loss_Cr = 0
+
+            if opt.w_loss_FA > 0:
+                loss_FA = criterion[0](student_out[1], teacher_output[1])
+            if opt.w_loss_L1 > 0:
+                loss_L1 = criterion[1](student_out[0], y)
+            if opt.w_loss_SSIM > 0:
+                loss_SSIM = (1 - criterion[2](student_out[0], y))
+            if opt.w_loss_Cr > 0:
+                loss_Cr = criterion[3](student_out[0], y, x)
+
+            loss = opt.w_loss_FA * loss_FA + opt.w_loss_L1 * loss_L1 + opt.w_loss_SSIM * loss_SSIM + opt.w_loss_Cr * loss_Cr
+        optimizer_step(loss, optim)
         optim.zero_grad()
+        images += x.size(0)
         losses.append(loss.item())
         loss_log_tmp['FA'].append(loss_FA.item())
         loss_log_tmp['L1'].append(loss_L1.item())
@@ -100,37 +148,61 @@ def train(teacher_net, student_net, loader_train_1, loader_test, optim, criterio
                         5 * len(loader_train_1))
             else:
                 epoch = int(step / opt.iters_per_epoch)
-            with torch.no_grad():
-                ssim_eval, psnr_eval = test(student_net, loader_test)
-
-            log = f'\nstep :{step} | epoch: {epoch} | ssim:{ssim_eval:.4f}| psnr:{psnr_eval:.4f} | lr:{lr:.12f}'
-            print(log)
-            with open(os.path.join(opt.saved_data_dir, 'log.txt'), 'a') as f:
-                f.write(log + '\n')
-
-            ssims.append(ssim_eval)
-            psnrs.append(psnr_eval)
-            psnr_log.append(psnr_eval)
+            throughput = images / (time.time() - train_start)
+            extra = f'lr:{lr:.12f} | amp:{opt.amp} | {throughput:.1f} img/s'
             state_dict = student_net.state_dict()
-            if 'module' in list(state_dict.keys())[0]:
-                from collections import OrderedDict
-                new_state_dict = OrderedDict()
-                for k, v in state_dict.items():
-                    name = k.replace('module.', '')
-                    new_state_dict[name] = v
-                state_dict = new_state_dict
-            if psnr_eval > max_psnr:
-                max_ssim = max(max_ssim, ssim_eval)
-                max_psnr = max(max_psnr, psnr_eval)
-                print(
-                    f'model saved at step :{step}| epoch: {epoch} | max_psnr:{max_psnr:.4f}| max_ssim:{max_ssim:.4f}')
-                saved_best_model_path = os.path.join(opt.saved_model_dir, 'best.pth')
-                torch.save(state_dict, saved_best_model_path)
-            saved_single_model_path = os.path.join(opt.saved_model_dir, str(epoch) + '.pth')
-            torch.save(state_dict, saved_single_model_path)
+            saved_paths = [os.path.join(opt.saved_model_dir, str(epoch) + '.pth')]
+
+            if isinstance(loader_test, EvalWorker):
+                # Logged and compared with best.pth by the worker; earlier results are collected here.
+                loader_test.submit(step, epoch, extra, state_dict)
+                results = loader_test.poll()
+                for _, ssim_eval, psnr_eval in results:
+                    if psnr_eval > max_psnr:
+                        max_ssim, max_psnr = max(max_ssim, ssim_eval), psnr_eval
+            else:
+                with torch.no_grad():
+                    ssim_eval, psnr_eval = test(student_net, loader_test)
+
+                log = f'\nstep :{step} | epoch: {epoch} | ssim:{ssim_eval:.4f}| psnr:{psnr_eval:.4f} | {extra}'
+                print(log)
+                with open(os.path.join(opt.saved_data_dir, 'log.txt'), 'a') as f:
+                    f.write(log + '\n')
+
+                if psnr_eval > max_psnr:
+                    max_ssim = max(max_ssim, ssim_eval)
+                    max_psnr = max(max_psnr, psnr_eval)
+                    print(
+                        f'model saved at step :{step}| epoch: {epoch} | max_psnr:{max_psnr:.4f}| max_ssim:{max_ssim:.4f}')
+                    saved_paths.append(os.path.join(opt.saved_model_dir, 'best.pth'))
+                results = [(step, ssim_eval, psnr_eval)]
+
+            for _, ssim_eval, psnr_eval in results:
+                ssims.append(ssim_eval)
+                psnrs.append(psnr_eval)
+                psnr_log.append(psnr_eval)
+            checkpoint_writer.save(state_dict, *saved_paths)
             loader_train_iter_1 = iter(loader_train_1)
             np.save(os.path.join(opt.saved_data_dir, 'ssims.npy'), ssims)
             np.save(os.path.join(opt.saved_data_dir, 'psnrs.npy'), psnrs)
+            images, train_start = 0, time.time()
+
+        if step % opt.state_every == 0 or step == steps:
+            checkpoint_writer.save_state(os.path.join(opt.saved_model_dir, 'last.pth'), student_net.state_dict(),
+                                         step=step, optimizer=optim.state_dict(),
+                                         scaler=scaler.state_dict() if scaler is not None else {},
+                                         max_ssim=max_ssim, max_psnr=max_psnr, ssims=ssims, psnrs=psnrs,
+                                         psnr_log=psnr_log, losses=losses, loss_log=loss_log,
+                                         loss_log_tmp=loss_log_tmp, rng=rng_state())
+
+    if isinstance(loader_test, EvalWorker):
+        for _, ssim_eval, psnr_eval in loader_test.close():
+            ssims.append(ssim_eval)
+            psnrs.append(psnr_eval)
+            psnr_log.append(psnr_eval)
+        np.save(os.path.join(opt.saved_data_dir, 'ssims.npy'), ssims)
+        np.save(os.path.join(opt.saved_data_dir, 'psnrs.npy'), psnrs)
+    checkpoint_writer.close()
 
 
 def pad_img(x, patch_size):
@@ -144,23 +216,22 @@ def pad_img(x, patch_size):
 def test(net, loader_test):
     net.eval()
     torch.cuda.empty_cache()
-    ssims = []
-    psnrs = []
+    metrics = MetricAccumulator()
 
-    for i, (inputs, targets, hazy_name) in enumerate(loader_test):
+    for i, (inputs, targets, masks, hazy_name) in enumerate(loader_test):
         inputs = inputs.to(opt.device)
         targets = targets.to(opt.device)
+        masks = masks.to(opt.device)
         with torch.no_grad():
             H, W = inputs.shape[2:]
             inputs = pad_img(inputs, 4)
-            pred = net(inputs)[0].clamp(0, 1)
+            with autocast():
+                pred = net(inputs, features=False)
+            pred = pred.float().clamp(0, 1)
             pred = pred[:, :, :H, :W]
-        ssim_tmp = ssim(pred, targets).item()
-        psnr_tmp = psnr(pred, targets)
-        ssims.append(ssim_tmp)
-        psnrs.append(psnr_tmp)
+        metrics.update(pred, targets, masks)
 
-    return np.mean(ssims), np.mean(psnrs)
+    return metrics.compute()
 
 
 def set_seed_torch(seed=2018):
@@ -176,21 +247,48 @@ if __name__ == "__main__":
     set_seed_torch(2024)
 
     train_dir_1 = './data/THaze/train'
-    train_set_1 = RESIDE_Dataset(train_dir_1, True, 256, '.jpg')
+    # The cached / worker teacher outputs belong to the crops as the dataset augmented them.
+    assert not (opt.batch_aug and (opt.teacher_cache or opt.teacher_worker)), \
+        '--batch_aug does not work with --teacher_cache or --teacher_worker'
+    if opt.teacher_cache:
+        train_set_1 = TeacherCacheDataset(train_dir_1, opt.teacher_cache, True, 256, '.jpg')
+    elif opt.packed:
+        train_set_1 = PackedDataset(opt.packed, True, 256, raw=opt.batch_aug)
+    else:
+        train_set_1 = RESIDE_Dataset(train_dir_1, True, 256, '.jpg', raw=opt.batch_aug,
+                                     index_file=opt.data_index)
 
     test_dir = './data/THaze/test'
     test_set = TestDataset(os.path.join(test_dir, 'hazy'), os.path.join(test_dir, 'clear'))
 
-    loader_train_1 = DataLoader(dataset=train_set_1, batch_size=24, shuffle=True, num_workers=8)
-    loader_test = DataLoader(dataset=test_set, batch_size=1, shuffle=False, num_workers=1)
+    loader_kwargs = dict(batch_size=24, shuffle=True, num_workers=8)
+    loader_train_1 = DataLoader(dataset=train_set_1, **loader_kwargs)
+    loader_test = DataLoader(dataset=test_set, batch_size=opt.test_batch_size, shuffle=False, num_workers=1,
+                             collate_fn=pad_collate)
 
-    teacher_net = Teacher()
-    teacher_net = teacher_net.to(opt.device)
-    teacher_net.load_state_dict(torch.load('./model/Teacher_model/Teacher.pth', map_location=torch.device("cpu")))
-    teacher_net.eval()
+    teacher_net = None
+    if not opt.teacher_cache:
+        teacher_net = Teacher()
+        teacher_net = teacher_net.to(opt.device)
+        teacher_net.load_state_dict(torch.load('./model/Teacher_model/Teacher.pth', map_location=torch.device("cpu")))
+        teacher_net.eval()
+        teacher_net.switch_to_deploy()
+    if opt.teacher_worker and teacher_net is not None:
+        # The worker yields the same (x, y, out, feats) batches as the Teacher cache.
+        loader_train_1 = TeacherWorker(teacher_net, train_set_1, loader_kwargs, opt.device, True, opt.teacher_queue,
+                                       opt.teacher_threads, amp_dtype)
+        teacher_net = None
 
     student_net = Student()
     student_net = student_net.to(opt.device)
+    resume = None
+    if opt.resume:
+        resume = load_training_state(opt.resume)
+        student_net.load_state_dict(resume['model'])
+    if opt.async_eval:
+        loader_test = EvalWorker(student_net, test_set, opt.test_batch_size, opt.device, opt.saved_model_dir,
+                                 opt.saved_data_dir, amp_dtype, max_ssim=resume['max_ssim'] if resume else 0,
+                                 max_psnr=resume['max_psnr'] if resume else 0)
 
     epoch_size = len(loader_train_1)
     print("epoch_size: ", epoch_size)
@@ -200,16 +298,23 @@ if __name__ == "__main__":
 
     pytorch_total_params = sum(p.numel() for p in student_net.parameters() if p.requires_grad)
     print("Total_params: ==> {}".format(pytorch_total_params))
+    print(f"amp: {opt.amp}")
     print("------------------------------------------------------------------")
 
     criterion = []
     criterion.append(FA().to(opt.device))
     criterion.append(nn.L1Loss().to(opt.device))
     criterion.append(SSIM().to(opt.device))
-    criterion.append(ContrastLoss(ablation=False))
+    criterion.append(ContrastLoss(ablation=False).to(opt.device))
 
     optimizer = optim.Adam(params=filter(lambda x: x.requires_grad, student_net.parameters()), lr=opt.start_lr,
                            betas=(0.9, 0.999),
                            eps=1e-08)
+    if resume is not None:
+        optimizer.load_state_dict(resume['optimizer'])
     optimizer.zero_grad()
-    train(teacher_net, student_net, loader_train_1, loader_test, optimizer, criterion)
+    try:
+        train(teacher_net, student_net, loader_train_1, loader_test, optimizer, criterion, resume)
+    finally:
+        if isinstance(loader_train_1, TeacherWorker):
+            loader_train_1.close()
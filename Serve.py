@@ -0,0 +1,165 @@
+import io
+import asyncio
+import torch
+import torchvision
+from concurrent.futures import ThreadPoolExecutor
+from torchvision.transforms import Resize, InterpolationMode
+from model import Teacher, Student, Student_x
+from Eval import load_image
+from option.Serve import opt
+
+# Local dehazing service:
+#   GET  /health   200 as soon as the server listens
+#   GET  /ready    200 once the model is loaded, 503 before
+#   POST /dehaze   body: a PNG/JPG image, response: the dehazed PNG
+# Requests are grouped by their padded size into batches of up to --max_batch images, waiting at most
+# --max_wait_ms for a batch to fill, and every batch runs in a single inference thread.
+
+STATUS = {200: '200 OK', 400: '400 Bad Request', 404: '404 Not Found', 500: '500 Internal Server Error',
+          503: '503 Service Unavailable'}
+
+
+def encode_png(out, size):
+    out = Resize(size, interpolation=InterpolationMode.BICUBIC, antialias=True)(out)
+    buffer = io.BytesIO()
+    torchvision.utils.save_image(out, buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class Batcher:
+    def __init__(self, max_batch, max_wait):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.model = None
+        self.device = torch.device(opt.device)
+        self.pending = {}
+        self.deadlines = {}
+        self.wakeup = asyncio.Event()
+        self.worker = ThreadPoolExecutor(1)
+
+    def load(self, model_name, model_path):
+        model = {'Teacher': Teacher, 'Student': Student, 'Student_x': Student_x}[model_name]().to(self.device)
+        model.load_state_dict(torch.load(model_path, map_location=self.device))
+        model.eval()
+        if isinstance(model, (Teacher, Student)):
+            model.switch_to_deploy()
+        self.model = model
+
+    def infer(self, hazes):
+        with torch.inference_mode():
+            return self.model(torch.stack(hazes).to(self.device), features=False).cpu()
+
+    async def submit(self, haze):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        key = tuple(haze.shape)
+        if key not in self.pending:
+            self.pending[key] = []
+            self.deadlines[key] = loop.time() + self.max_wait
+        self.pending[key].append((haze, future))
+        self.wakeup.set()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            ready = [key for key in self.pending
+                     if len(self.pending[key]) >= self.max_batch or self.deadlines[key] <= now]
+            if not ready:
+                timeout = min(self.deadlines.values()) - now if self.deadlines else None
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            key = min(ready, key=self.deadlines.get)
+            batch, rest = self.pending[key][:self.max_batch], self.pending[key][self.max_batch:]
+            if rest:
+                self.pending[key] = rest
+            else:
+                del self.pending[key], self.deadlines[key]
+
+            try:
+                outs = await loop.run_in_executor(self.worker, self.infer, [haze for haze, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), out in zip(batch, outs):
+                if not future.done():
+                    future.set_result(out)
+
+
+class Server:
+    def __init__(self):
+        self.batcher = Batcher(opt.max_batch, opt.max_wait_ms / 1000)
+        self.io = ThreadPoolExecutor(opt.io_workers)
+        self.ready = False
+
+    async def dehaze(self, body):
+        loop = asyncio.get_running_loop()
+        try:
+            _, haze, size = await loop.run_in_executor(self.io, load_image, io.BytesIO(body))
+        except Exception as e:
+            return 400, 'text/plain', f'cannot decode image: {e}'.encode()
+        out = await self.batcher.submit(haze)
+        return 200, 'image/png', await loop.run_in_executor(self.io, encode_png, out, size)
+
+    async def route(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return 200, 'text/plain', b'ok'
+        if method == 'GET' and path == '/ready':
+            return (200, 'text/plain', b'ready') if self.ready else (503, 'text/plain', b'loading')
+        if method == 'POST' and path == '/dehaze':
+            if not self.ready:
+                return 503, 'text/plain', b'loading'
+            return await self.dehaze(body)
+        return 404, 'text/plain', b'not found'
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                try:
+                    status, content_type, payload = await self.route(method, path, body)
+                except Exception as e:
+                    status, content_type, payload = 500, 'text/plain', str(e).encode()
+                writer.write(f'HTTP/1.1 {STATUS[status]}\r\nContent-Type: {content_type}\r\n'
+                             f'Content-Length: {len(payload)}\r\n\r\n'.encode('latin-1') + payload)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, opt.host, opt.port)
+        print(f'listening on http://{opt.host}:{opt.port}')
+        batcher = asyncio.create_task(self.batcher.run())
+        await asyncio.get_running_loop().run_in_executor(None, self.batcher.load, opt.model, opt.model_path)
+        self.ready = True
+        print(f'{opt.model} loaded from {opt.model_path}, ready')
+        async with server:
+            await asyncio.gather(server.serve_forever(), batcher)
+
+
+if __name__ == '__main__':
+    asyncio.run(Server().serve())
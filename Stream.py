@@ -0,0 +1,69 @@
+import sys
+import time
+import numpy as np
+import torch
+from torch.backends import cudnn
+from model import Teacher, Student, Student_x
+from option.Stream import opt
+
+# Dehazes raw rgb24 frames of a fixed size read from stdin and writes raw rgb24 frames to stdout, e.g.
+# ffmpeg -i in.mp4 -f rawvideo -pix_fmt rgb24 - | python Stream.py --width 1920 --height 1080 |
+#     ffmpeg -f rawvideo -pix_fmt rgb24 -s 1920x1080 -r 25 -i - out.mp4
+
+def read_frame(stream, buffer):
+    view = memoryview(buffer)
+    filled = 0
+    while filled < len(buffer):
+        n = stream.readinto(view[filled:])
+        if not n:
+            if filled:
+                raise EOFError(f'stream ended in the middle of a frame ({filled}/{len(buffer)} bytes)')
+            return False
+        filled += n
+    return True
+
+
+if __name__ == '__main__':
+    device = torch.device(opt.device)
+    model = {'Teacher': Teacher, 'Student': Student, 'Student_x': Student_x}[opt.model]().to(device)
+    model.load_state_dict(torch.load(opt.model_path, map_location=device))
+    model.eval()
+    # The model takes the 0-255 frames directly, its normalization front-end is folded into the first conv.
+    model.set_input_normalization()
+    if isinstance(model, (Teacher, Student)):
+        model.switch_to_deploy()
+    model.fold_input_normalization()
+    if device.type == 'cuda':
+        # The input shape never changes, so the convolution algorithms are only searched once.
+        cudnn.benchmark = True
+
+    H, W = opt.height, opt.width
+    H_pad, W_pad = (H + 15) // 16 * 16, (W + 15) // 16 * 16
+
+    # All frame buffers are allocated once and reused: the raw input bytes, the padded network input
+    # and the raw output bytes.
+    frame_bytes = bytearray(H * W * 3)
+    frame = torch.from_numpy(np.frombuffer(frame_bytes, dtype=np.uint8).reshape(H, W, 3))
+    haze = torch.empty(1, 3, H_pad, W_pad, device=device)
+    result = torch.empty(H, W, 3, dtype=torch.uint8)
+    result_bytes = result.numpy().data
+
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    frames = 0
+    start = time.perf_counter()
+    with torch.inference_mode():
+        while read_frame(stdin, frame_bytes):
+            haze[:, :, :H, :W].copy_(frame.permute(2, 0, 1).unsqueeze(0))
+            for k in range(H_pad - H):
+                haze[:, :, H + k, :W].copy_(haze[:, :, H - 2 - k, :W])
+            for k in range(W_pad - W):
+                haze[:, :, :, W + k].copy_(haze[:, :, :, W - 2 - k])
+
+            out = model(haze, features=False)[0, :, :H, :W].clamp_(0, 1).mul_(255).round_()
+            result.copy_(out.permute(1, 2, 0))
+            stdout.write(result_bytes)
+            frames += 1
+    stdout.flush()
+
+    elapsed = time.perf_counter() - start
+    print(f'frames: {frames} | {frames / max(elapsed, 1e-9):.2f} frames/s', file=sys.stderr)
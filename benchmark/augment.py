@@ -0,0 +1,54 @@
+import argparse
+import random
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import ToTensor, RandomHorizontalFlip
+from torchvision.transforms import functional as FF
+from data.data_loader import preprocess_feature
+from data.augment import prepare_batch
+from benchmark.common import time_it
+
+# Compares the per-sample PIL augmentation of RESIDE_Dataset.augData with data.augment.prepare_batch on the collated
+# uint8 batch (--batch_aug), for one training batch of hazy/clear crops. Also reports the bytes a loader worker
+# sends to the main process per batch.
+# Run from the repo root: python -m benchmark.augment --bs 24 --size 256
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=int, default=256, help='crop size')
+parser.add_argument('--bs', type=int, default=24)
+parser.add_argument('--iters', type=int, default=10)
+opt = parser.parse_args()
+
+
+def pil_augment(haze, clear):
+    # RESIDE_Dataset.augData
+    rand_hor = random.randint(0, 1)
+    rand_rot = random.randint(0, 3)
+    haze = RandomHorizontalFlip(rand_hor)(haze)
+    clear = RandomHorizontalFlip(rand_hor)(clear)
+    if rand_rot:
+        haze = FF.rotate(haze, 90 * rand_rot)
+        clear = FF.rotate(clear, 90 * rand_rot)
+    return preprocess_feature(haze), ToTensor()(clear)
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    crops = [tuple(Image.fromarray(np.random.randint(0, 256, (opt.size, opt.size, 3), dtype=np.uint8))
+                   for _ in range(2)) for _ in range(opt.bs)]
+    raw = [tuple(FF.pil_to_tensor(img) for img in pair) for pair in crops]
+
+    def per_sample():
+        samples = [pil_augment(haze, clear) for haze, clear in crops]
+        return torch.stack([s[0] for s in samples]).to(device), torch.stack([s[1] for s in samples]).to(device)
+
+    def batched():
+        haze = torch.stack([s[0] for s in raw]).to(device)
+        clear = torch.stack([s[1] for s in raw]).to(device)
+        return prepare_batch(haze, clear)
+
+    for name, fn, dtype in (('per-sample PIL', per_sample, torch.float32), ('batched', batched, torch.uint8)):
+        seconds = time_it(fn, device, opt.iters)
+        transfer = 2 * opt.bs * 3 * opt.size ** 2 * torch.empty(0, dtype=dtype).element_size()
+        print(f'{name:14s} | {seconds * 1000:.2f} ms / batch | worker -> main: {transfer / 2 ** 20:.1f} MB / batch')
@@ -0,0 +1,52 @@
+import argparse
+import torch
+import torch.nn.functional as F
+from benchmark.common import build_model, time_it, reset_peak_memory, peak_memory_mb
+
+# Peak memory and training step time of the Teacher for each activation checkpointing setting
+# (Teacher.set_checkpoint / --checkpoint in option/Teacher.py).
+# Run from the repo root: python -m benchmark.checkpoint --bs 24 --size 256 256
+#
+# On CPU the peak memory is the process max RSS, so the settings run from the most to the least checkpointed.
+
+SETTINGS = [
+    ['encoder', 'dehaze', 'decoder'],
+    ['encoder'],
+    ['dehaze'],
+    ['decoder'],
+    [],
+]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='H W of the crops')
+parser.add_argument('--bs', type=int, default=24)
+parser.add_argument('--iters', type=int, default=5)
+opt = parser.parse_args()
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = build_model('Teacher', '', device, deploy=False).train()
+    x = torch.rand(opt.bs, 3, *opt.size, device=device)
+    y = torch.rand(opt.bs, 3, *opt.size, device=device)
+
+    def step():
+        F.l1_loss(model(x, features=False), y).backward()
+        model.zero_grad(set_to_none=True)
+
+    grads = {}
+    for segments in SETTINGS:
+        model.set_checkpoint(segments)
+        reset_peak_memory(device)
+        seconds = time_it(step, device, opt.iters, warmup=1)
+        peak = peak_memory_mb(device)
+        print(f'{"+".join(segments) or "none":22s} | peak memory: {peak:.1f} MB | step: {seconds * 1000:.1f} ms')
+
+        # Train mode normalizes with batch statistics, so the gradients must match the run without checkpointing.
+        F.l1_loss(model(x, features=False), y).backward()
+        grads[tuple(segments)] = model.conv_output.conv2d.weight.grad.clone()
+        model.zero_grad(set_to_none=True)
+
+    ref = grads[()]
+    for segments, grad in grads.items():
+        print(f'{"+".join(segments) or "none":22s} | grad diff: {(grad - ref).abs().max().item():.2e}')
@@ -0,0 +1,44 @@
+import resource
+import time
+import torch
+from model import Teacher, Student, Student_x
+
+MODELS = {'Teacher': Teacher, 'Student': Student, 'Student_x': Student_x}
+
+
+def build_model(name, weights, device, deploy=True):
+    model = MODELS[name]().to(device)
+    if weights:
+        model.load_state_dict(torch.load(weights, map_location=device))
+    model.eval()
+    if deploy and isinstance(model, (Teacher, Student)):
+        model.switch_to_deploy()
+    return model
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def reset_peak_memory(device):
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device):
+    # On CPU this is the max RSS of the whole process, which never goes down: measure the cheaper setting first.
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def time_it(fn, device, iters=10, warmup=2):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters
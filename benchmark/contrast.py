@@ -0,0 +1,55 @@
+import argparse
+import torch
+from loss import ContrastLoss
+from benchmark.common import time_it, reset_peak_memory, peak_memory_mb
+
+# Compares ContrastLoss (one grad-tracked VGG pass for the anchor, one batched no_grad pass for positive and
+# negative) with the original three full-graph VGG passes: loss value, forward + backward time and peak memory.
+# Run from the repo root: python -m benchmark.contrast --bs 24 --size 256 256
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='H W of the crops')
+parser.add_argument('--bs', type=int, default=8)
+parser.add_argument('--iters', type=int, default=5)
+opt = parser.parse_args()
+
+
+def reference_loss(criterion, a, p, n):
+    # ContrastLoss.forward before the batched target pass.
+    a, p, n = [(t - criterion.mean) / criterion.std for t in (a, p, n)]
+    a_vgg, p_vgg, n_vgg = criterion.vgg(a), criterion.vgg(p), criterion.vgg(n)
+    loss = 0
+    for i in range(len(a_vgg)):
+        d_ap = criterion.l1(a_vgg[i], p_vgg[i].detach())
+        if not criterion.ab:
+            d_an = criterion.l1(a_vgg[i], n_vgg[i].detach())
+            contrastive = d_ap / (d_an + 1e-7)
+        else:
+            contrastive = d_ap
+        loss += criterion.weights[i] * contrastive
+    return loss
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    criterion = ContrastLoss(ablation=False).to(device)
+    a = torch.rand(opt.bs, 3, *opt.size, device=device, requires_grad=True)
+    p = torch.rand(opt.bs, 3, *opt.size, device=device)
+    n = torch.rand(opt.bs, 3, *opt.size, device=device)
+
+    results = {}
+    for name, fn in (('batched', criterion), ('original', lambda *args: reference_loss(criterion, *args))):
+        def step():
+            fn(a, p, n).backward()
+            a.grad = None
+
+        reset_peak_memory(device)
+        seconds = time_it(step, device, opt.iters, warmup=1)
+        peak = peak_memory_mb(device)
+        loss = fn(a, p, n)
+        loss.backward()
+        results[name] = loss.item(), a.grad.clone()
+        a.grad = None
+        print(f'{name:8s} | loss: {loss.item():.8f} | step: {seconds * 1000:.1f} ms | peak memory: {peak:.1f} MB')
+    grad_diff = (results['batched'][1] - results['original'][1]).abs().max().item()
+    print(f'loss diff: {abs(results["batched"][0] - results["original"][0]):.2e} | grad diff: {grad_diff:.2e}')
@@ -0,0 +1,35 @@
+import argparse
+import torch
+from data.data_loader import CLIP_MEAN, CLIP_STD
+from benchmark.common import build_model, time_it
+
+# Compares the usual input path (uint8 -> float -> CLIP normalization, then the deploy-mode model) with uint8 images
+# fed to the model whose normalization front-end is folded into its first conv: output difference and time per
+# batch, input conversion included.
+# Run from the repo root: python -m benchmark.input_norm --size 512 512
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', type=str, nargs='+', default=['Student_x', 'Student', 'Teacher'])
+parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='H W of the input')
+parser.add_argument('--bs', type=int, default=2)
+parser.add_argument('--iters', type=int, default=5)
+opt = parser.parse_args()
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    images = torch.randint(0, 256, (opt.bs, 3, *opt.size), dtype=torch.uint8, device=device)
+    mean = torch.tensor(CLIP_MEAN, device=device).view(1, 3, 1, 1)
+    std = torch.tensor(CLIP_STD, device=device).view(1, 3, 1, 1)
+    for name in opt.models:
+        model = build_model(name, '', device)
+        with torch.no_grad():
+            normalized = lambda: model((images.float() / 255 - mean) / std, features=False)
+            ref = normalized()
+            loader = time_it(normalized, device, opt.iters)
+            model.set_input_normalization().fold_input_normalization()
+            out = model(images, features=False)
+            folded = time_it(lambda: model(images, features=False), device, opt.iters)
+        diff = (out - ref).abs().max().item()
+        print(f'{name:9s} | normalize + model: {loader * 1000:.1f} ms | uint8 + folded front-end: '
+              f'{folded * 1000:.1f} ms | max diff: {diff:.2e}')
@@ -0,0 +1,111 @@
+import argparse
+import torch
+import torch.nn as nn
+from benchmark.common import build_model, time_it
+
+# Exact cost model and timing of the MDC fusion blocks (Encoder_MDCBlock1 / Decoder_MDCBlock1).
+# Run from the repo root: python -m benchmark.mdc --model Student_x
+#
+# In 'iter2' mode, used by all three models, chain i starts from the fusion result of chain i - 1, so no
+# intermediate result can be shared between chains and the table below is the work that remains. In 'iter4'
+# mode every chain starts from the block input and the shorter chains reuse the prefixes of the longest one.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='Student_x', choices=['Teacher', 'Student', 'Student_x'])
+parser.add_argument('--sizes', type=int, nargs='+', default=[256, 1024], help='square input sizes')
+parser.add_argument('--iters', type=int, default=5)
+opt = parser.parse_args()
+
+
+def conv_cost(conv, h, w):
+    k, s, p = conv.kernel_size[0], conv.stride[0], conv.padding[0]
+    if isinstance(conv, nn.ConvTranspose2d):
+        h_out, w_out = (h - 1) * s - 2 * p + k, (w - 1) * s - 2 * p + k
+        macs = conv.in_channels * conv.out_channels * k * k * h * w
+    else:
+        h_out, w_out = (h + 2 * p - k) // s + 1, (w + 2 * p - k) // s + 1
+        macs = conv.in_channels * conv.out_channels * k * k * h_out * w_out
+    return macs, h_out, w_out
+
+
+def chain_cost(layers, h, w):
+    macs = 0
+    for layer in layers:
+        conv = layer.deconv if hasattr(layer, 'deconv') else layer.conv
+        m, h, w = conv_cost(conv, h, w)
+        macs += m
+    return macs, h, w
+
+
+def block_cost(block, h, w, n, mode):
+    # MACs of every chain, following the indices of the forward pass. Encoder blocks go up then down,
+    # decoder blocks go down then up.
+    encoder = type(block).__name__.startswith('Encoder')
+    first, second = (block.up_convs, block.down_convs) if encoder else (block.down_convs, block.up_convs)
+    chains = []
+    if mode == 'iter4':
+        prefix, _, _ = chain_cost(first, h, w)
+        chains.append(prefix)
+    for i in range(n):
+        length = block.num_ft - i
+        macs, h_mid, w_mid = chain_cost(first[:length], h, w)
+        back, _, _ = chain_cost([second[length - j - 1] for j in range(length)], h_mid, w_mid)
+        chains.append(back + (macs if mode == 'iter2' else 0))
+    return chains
+
+
+def reference_forward(block, ft, ft_list, mode):
+    # The original chains, recomputed from scratch for every element of ft_list.
+    encoder = type(block).__name__.startswith('Encoder')
+    first, second = (block.up_convs, block.down_convs) if encoder else (block.down_convs, block.up_convs)
+    ft_fusion = ft
+    for i in range(len(ft_list)):
+        x = ft_fusion if mode == 'iter2' else ft
+        for j in range(block.num_ft - i):
+            x = first[j](x)
+        x = x - ft_list[i]
+        for j in range(block.num_ft - i):
+            x = second[block.num_ft - i - j - 1](x)
+        ft_fusion = ft_fusion + x
+    return ft_fusion
+
+
+def record_calls(model, x):
+    calls = []
+    hooks = [m.register_forward_hook(lambda m, inputs, out, name=name: calls.append((name, m, inputs)))
+             for name, m in model.named_modules() if type(m).__name__ in ('Encoder_MDCBlock1', 'Decoder_MDCBlock1')]
+    convs = {}
+    hooks += [m.register_forward_hook(lambda m, inputs, out, name=name: convs.__setitem__(
+        name, convs.get(name, 0) + conv_cost(m, *inputs[0].shape[2:])[0] * inputs[0].shape[0]))
+        for name, m in model.named_modules() if isinstance(m, (nn.Conv2d, nn.ConvTranspose2d))]
+    with torch.no_grad():
+        model(x)
+    for hook in hooks:
+        hook.remove()
+    return calls, convs
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = build_model(opt.model, '', device)
+    for size in opt.sizes:
+        x = torch.randn(1, 3, size, size, device=device)
+        calls, convs = record_calls(model, x)
+        model_macs = sum(convs.values())
+        fusion_macs = sum(v for k, v in convs.items() if k.startswith('fusion'))
+        print(f'\n{opt.model} {size}x{size} | conv GMACs: {model_macs / 1e9:.2f} | '
+              f'MDC fusion GMACs: {fusion_macs / 1e9:.2f} ({100 * fusion_macs / model_macs:.1f}%)')
+
+        for name, block, (ft, ft_list) in calls:
+            h, w = ft.shape[2:]
+            chains = block_cost(block, h, w, len(ft_list), block.mode)
+            with torch.no_grad():
+                ref = reference_forward(block, ft, ft_list, block.mode)
+                new = block(ft, ft_list)
+                t_ref = time_it(lambda: reference_forward(block, ft, ft_list, block.mode), device, opt.iters)
+                t_new = time_it(lambda: block(ft, ft_list), device, opt.iters)
+                iter4 = block_cost(block, h, w, len(ft_list), 'iter4')
+            print(f'{name:10s} {block.mode} {h}x{w} | chains (MMACs): '
+                  f'{", ".join(f"{c / 1e6:.1f}" for c in chains)} | total: {sum(chains) / 1e6:.1f} MMACs '
+                  f'| old: {t_ref * 1000:.2f} ms | new: {t_new * 1000:.2f} ms | '
+                  f'max diff: {(ref - new).abs().max().item():.2e} | iter4 with reuse: {sum(iter4) / 1e6:.1f} MMACs')
@@ -0,0 +1,48 @@
+import argparse
+import torch
+from benchmark.common import build_model, time_it, reset_peak_memory, peak_memory_mb
+
+# Compares the image-only forward (features=False) with the default forward that also returns the
+# distillation features, for inference and for a training step.
+# Run from the repo root: python -m benchmark.output_mode --size 256 256
+#
+# On CPU the peak memory is the process max RSS, so the image-only mode is always measured first.
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', type=str, nargs='+', default=['Student_x', 'Student', 'Teacher'])
+parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='H W of the input')
+parser.add_argument('--bs', type=int, default=2)
+parser.add_argument('--iters', type=int, default=5)
+opt = parser.parse_args()
+
+
+def train_step(model, x, features):
+    out = model(x, features=features)
+    loss = out.mean() if not features else out[0].mean() + sum(f.mean() for f in out[1])
+    loss.backward()
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    x = torch.randn(opt.bs, 3, *opt.size, device=device)
+    for name in opt.models:
+        model = build_model(name, '', device, deploy=False)
+        results = {}
+        for features in (False, True):
+            with torch.no_grad():
+                reset_peak_memory(device)
+                infer = time_it(lambda: model(x, features=features), device, opt.iters)
+                infer_peak = peak_memory_mb(device)
+            model.train()
+            reset_peak_memory(device)
+            train = time_it(lambda: train_step(model, x, features), device, opt.iters)
+            train_peak = peak_memory_mb(device)
+            model.zero_grad(set_to_none=True)
+            model.eval()
+            results[features] = infer, infer_peak, train, train_peak
+        with torch.no_grad():
+            same = torch.equal(model(x, features=False), model(x)[0])
+        for features, (infer, infer_peak, train, train_peak) in results.items():
+            print(f'{name} | {"features  " if features else "image only"} | inference: {infer * 1000:.1f} ms, '
+                  f'{infer_peak:.1f} MB | train step: {train * 1000:.1f} ms, {train_peak:.1f} MB')
+        print(f'{name} | identical images: {same}')
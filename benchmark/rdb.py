@@ -0,0 +1,46 @@
+import argparse
+import torch
+from torch.profiler import profile, ProfilerActivity
+from model.Teacher import RDB as TeacherRDB
+from model.Student import RDB as StudentRDB
+from model.Student_x import RDB as StudentxRDB
+from benchmark.common import build_model, time_it
+
+# Compares the preallocated RDB buffer with the original torch.cat dense layers at inference time.
+# Run from the repo root: python -m benchmark.rdb --size 512 512
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', type=str, nargs='+', default=['Student_x', 'Student', 'Teacher'])
+parser.add_argument('--size', type=int, nargs=2, default=[512, 512], help='H W of the input')
+parser.add_argument('--iters', type=int, default=10)
+opt = parser.parse_args()
+
+
+def set_preallocate(model, enabled):
+    for m in model.modules():
+        if isinstance(m, (TeacherRDB, StudentRDB, StudentxRDB)):
+            m.preallocate = enabled
+
+
+def allocations(model, x):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        model(x, features=False)
+    events = [e for e in prof.key_averages() if e.self_cpu_memory_usage > 0]
+    return sum(e.count for e in events), sum(e.self_cpu_memory_usage for e in events) / 2 ** 20
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    x = torch.randn(1, 3, *opt.size, device=device)
+    with torch.no_grad():
+        for name in opt.models:
+            model = build_model(name, '', device)
+            outputs = {}
+            for enabled in (False, True):
+                set_preallocate(model, enabled)
+                outputs[enabled] = model(x, features=False)
+                seconds = time_it(lambda: model(x, features=False), device, opt.iters)
+                count, mb = allocations(model, x)
+                print(f'{name} | {"buffer" if enabled else "cat   "} | {seconds * 1000:.1f} ms | '
+                      f'allocations: {count} | allocated: {mb:.1f} MB')
+            print(f'{name} | identical outputs: {torch.equal(outputs[False], outputs[True])}')
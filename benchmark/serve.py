@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import time
+
+# Load generator for Serve.py. Start the server first, then run from the repo root:
+# python -m benchmark.serve --image ./test/1.png --requests 200 --concurrency 16
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--image', type=str, required=True, help='image posted with every request')
+parser.add_argument('--requests', type=int, default=200)
+parser.add_argument('--concurrency', type=int, default=16, help='number of clients sending requests back to back')
+opt = parser.parse_args()
+
+
+async def request(reader, writer, method, path, body=b''):
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {opt.host}\r\nContent-Length: {len(body)}\r\n\r\n'
+                 .encode('latin-1') + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, await reader.readexactly(length)
+
+
+async def wait_ready():
+    while True:
+        try:
+            reader, writer = await asyncio.open_connection(opt.host, opt.port)
+            status, _ = await request(reader, writer, 'GET', '/ready')
+            writer.close()
+            if status == 200:
+                return
+        except ConnectionError:
+            pass
+        await asyncio.sleep(0.5)
+
+
+async def client(body, remaining, latencies):
+    reader, writer = await asyncio.open_connection(opt.host, opt.port)
+    while remaining:
+        remaining.pop()
+        start = time.perf_counter()
+        status, _ = await request(reader, writer, 'POST', '/dehaze', body)
+        if status != 200:
+            raise RuntimeError(f'request failed with status {status}')
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def main():
+    with open(opt.image, 'rb') as f:
+        body = f.read()
+    await wait_ready()
+
+    remaining = list(range(opt.requests))
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(body, remaining, latencies) for _ in range(opt.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    print(f'requests: {len(latencies)} | concurrency: {opt.concurrency} | throughput: {len(latencies) / elapsed:.2f} images/s')
+    print(f'latency (ms) | p50: {percentile(latencies, 50) * 1000:.1f} | p99: {percentile(latencies, 99) * 1000:.1f} | '
+          f'max: {max(latencies) * 1000:.1f}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+import argparse
+import torch
+import torch.nn.functional as F
+from metric.metric import gaussian, structural_similarity
+from benchmark.common import time_it
+
+# Compares the separable SSIM engine (metric.structural_similarity, used by loss.SSIM and metric.ssim) with the
+# original five dense 11x11 grouped convs, as a loss (forward + backward) and as a metric.
+# Run from the repo root: python -m benchmark.ssim --bs 24 --size 256 256
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--size', type=int, nargs=2, default=[256, 256], help='H W of the images')
+parser.add_argument('--bs', type=int, default=8)
+parser.add_argument('--iters', type=int, default=10)
+opt = parser.parse_args()
+
+
+def reference_ssim(img1, img2, window_size=11):
+    channel = img1.shape[1]
+    g = gaussian(window_size, 1.5).unsqueeze(1)
+    window = g.mm(g.t()).expand(channel, 1, window_size, window_size).contiguous().to(img1.device)
+    pad = window_size // 2
+    mu1 = F.conv2d(img1, window, padding=pad, groups=channel)
+    mu2 = F.conv2d(img2, window, padding=pad, groups=channel)
+    sigma1_sq = F.conv2d(img1 * img1, window, padding=pad, groups=channel) - mu1.pow(2)
+    sigma2_sq = F.conv2d(img2 * img2, window, padding=pad, groups=channel) - mu2.pow(2)
+    sigma12 = F.conv2d(img1 * img2, window, padding=pad, groups=channel) - mu1 * mu2
+    C1 = 0.01 ** 2
+    C2 = 0.03 ** 2
+    ssim_map = ((2 * mu1 * mu2 + C1) * (2 * sigma12 + C2)) / ((mu1.pow(2) + mu2.pow(2) + C1) * (sigma1_sq + sigma2_sq + C2))
+    return ssim_map.mean(1).mean(1).mean(1)
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    a = torch.rand(opt.bs, 3, *opt.size, device=device, requires_grad=True)
+    b = (a.detach() + 0.1 * torch.randn_like(a)).clamp(0, 1)
+
+    for name, fn in (('separable', lambda: structural_similarity(a, b, size_average=False)),
+                     ('dense', lambda: reference_ssim(a, b))):
+        def loss_step():
+            (1 - fn().mean()).backward()
+            a.grad = None
+
+        with torch.no_grad():
+            metric = time_it(fn, device, opt.iters)
+        loss = time_it(loss_step, device, opt.iters)
+        print(f'{name:9s} | metric: {metric * 1000:.2f} ms | loss step: {loss * 1000:.2f} ms')
+
+    with torch.no_grad():
+        diff = (structural_similarity(a, b, size_average=False) - reference_ssim(a, b)).abs().max().item()
+    print(f'max per-image diff: {diff:.2e}')
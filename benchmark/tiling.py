@@ -0,0 +1,47 @@
+import argparse
+import torch
+from PIL import Image
+from Eval import transform, dehaze_tiled, pad_img
+from benchmark.common import build_model, reset_peak_memory, peak_memory_mb
+
+# Compares tiled inference with whole-image inference on the same (16-padded) input.
+# Run from the repo root: python -m benchmark.tiling --model Student_x --weights ./model/EMA_model/EMA_r.pth
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='Student_x', choices=['Teacher', 'Student', 'Student_x'])
+parser.add_argument('--weights', type=str, default='')
+parser.add_argument('--image', type=str, default='', help='hazy image, a random input is used if empty')
+parser.add_argument('--size', type=int, nargs=2, default=[1024, 1536], help='H W of the random input')
+parser.add_argument('--tile_size', type=int, default=512)
+parser.add_argument('--tile_overlap', type=int, default=64)
+parser.add_argument('--tile_batch', type=int, default=4)
+parser.add_argument('--atol', type=float, default=1e-2, help='max abs difference allowed on the [0, 1] output')
+opt = parser.parse_args()
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = build_model(opt.model, opt.weights, device)
+
+    if opt.image:
+        haze = transform(Image.open(opt.image).convert("RGB")).unsqueeze(0).to(device)
+    else:
+        haze = torch.randn(1, 3, *opt.size, device=device)
+    h, w = haze.shape[2:]
+
+    with torch.no_grad():
+        reset_peak_memory(device)
+        tiled = dehaze_tiled(model, haze, opt.tile_size, opt.tile_overlap, opt.tile_batch).clamp(0, 1)
+        tiled_peak = peak_memory_mb(device)
+
+        reset_peak_memory(device)
+        whole = model(pad_img(haze, 16), features=False)[:, :, :h, :w].clamp(0, 1)
+        whole_peak = peak_memory_mb(device)
+
+    diff = (tiled - whole).abs()
+    mse = diff.pow(2).mean().item()
+    print(f'input: {h}x{w} | tile: {opt.tile_size} | overlap: {opt.tile_overlap} | batch: {opt.tile_batch}')
+    print(f'peak memory (MB) | tiled: {tiled_peak:.1f} | whole image: {whole_peak:.1f}')
+    print(f'max abs diff: {diff.max().item():.6f} | mean abs diff: {diff.mean().item():.6f} | '
+          f'psnr: {10 * torch.log10(torch.tensor(1 / max(mse, 1e-10))).item():.2f}')
+    if diff.max().item() > opt.atol:
+        raise SystemExit(f'tiled output differs from whole-image output by more than {opt.atol}')
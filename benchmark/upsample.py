@@ -0,0 +1,68 @@
+import argparse
+import torch
+from model.Teacher import UpsampleConvLayer as TeacherUpsample
+from model.Student import UpsampleConvLayer as StudentUpsample
+from model.Student_x import UpsampleConvLayer as StudentxUpsample
+from benchmark.common import build_model, time_it
+
+# Checks the fused decoder upsampling (1x1 conv before the nearest upsample, nearest + bilinear merged into
+# one resample) against the original path, layer by layer and for the whole models.
+# Run from the repo root: python -m benchmark.upsample
+#
+# Running the 1x1 conv first is exact: every output pixel of the nearest upsample is a copy of one input
+# pixel, so conv(upsample(x)) and upsample(conv(x)) compute the same dot products. The merged resample uses
+# the same source pixels and lambdas as the two-step resample, but when two bilinear taps fall on the same
+# nearest source pixel their weights are summed first, so it only matches up to float rounding:
+# RESAMPLE_ATOL below, relative to the largest activation.
+
+RESAMPLE_ATOL = 1e-5
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--models', type=str, nargs='+', default=['Student_x', 'Student', 'Teacher'])
+parser.add_argument('--size', type=int, nargs=2, default=[512, 512], help='H W of the input')
+parser.add_argument('--iters', type=int, default=10)
+opt = parser.parse_args()
+
+
+def upsample_layers(model):
+    return [m for m in model.modules() if isinstance(m, (TeacherUpsample, StudentUpsample, StudentxUpsample))]
+
+
+def set_fused(model, fused):
+    for m in upsample_layers(model):
+        m.fused = fused
+
+
+def compare(a, b):
+    return (a - b).abs().max().item() / max(1.0, b.abs().max().item())
+
+
+if __name__ == '__main__':
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    failed = False
+    with torch.no_grad():
+        for name in opt.models:
+            model = build_model(name, '', device)
+            for layer in upsample_layers(model):
+                x = torch.randn(2, layer.conv2d.in_channels, opt.size[0] // 32, opt.size[1] // 32, device=device)
+                size = (x.shape[2] * 2, x.shape[3] * 2)
+                outputs = {}
+                for fused in (False, True):
+                    layer.fused = fused
+                    outputs[fused] = layer(x), layer(x, size)
+                reorder, merged = compare(outputs[True][0], outputs[False][0]), compare(outputs[True][1], outputs[False][1])
+                failed |= reorder > 1e-6 or merged > RESAMPLE_ATOL
+                print(f'{name} | {layer.conv2d.in_channels}->{layer.conv2d.out_channels} | '
+                      f'conv reorder diff: {reorder:.2e} | merged resample diff: {merged:.2e}')
+
+            x = torch.randn(1, 3, *opt.size, device=device)
+            outputs, times = {}, {}
+            for fused in (False, True):
+                set_fused(model, fused)
+                outputs[fused] = model(x, features=False)
+                times[fused] = time_it(lambda: model(x, features=False), device, opt.iters)
+            diff = compare(outputs[True], outputs[False])
+            print(f'{name} | model output diff: {diff:.2e} | original: {times[False] * 1000:.1f} ms | '
+                  f'fused: {times[True] * 1000:.1f} ms')
+    if failed:
+        raise SystemExit('fused upsampling does not match the original path')
@@ -1 +1,6 @@
-from .data_loader import RESIDE_Dataset, TestDataset, CLIP_loader, RESIDE_Dataset_2
+from .data_loader import RESIDE_Dataset, TestDataset, CLIP_loader, RESIDE_Dataset_2, pad_collate
+from .teacher_cache import TeacherCacheDataset, build_teacher_cache
+from .teacher_worker import TeacherWorker
+from .packed import PackedDataset, pack_dataset
+from .augment import augment_batch, normalize_batch, prepare_batch
+from .index import DatasetIndex, build_index
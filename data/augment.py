@@ -0,0 +1,47 @@
+import torch
+from .data_loader import CLIP_MEAN, CLIP_STD
+
+# Batched version of the per-sample PIL augmentation in RESIDE_Dataset.augData / CLIP_loader.augData. With raw=True
+# the datasets return uint8 CHW crops, so the loader workers only decode and crop and a quarter of the bytes go to
+# the main process. The collated batch is flipped and rotated per sample by indexing, then converted to float and
+# normalized once, on whatever device it is on.
+
+
+def augment_batch(*batches):
+    # A random horizontal flip followed by a rotation by k * 90 degrees for every sample, the same for all the given
+    # batches (hazy and clear stay paired). torch.rot90 over (H, W) turns counter-clockwise like FF.rotate.
+    # Rotations by 90 and 270 degrees need square crops.
+    x = torch.cat(batches, 1) if len(batches) > 1 else batches[0]
+    assert x.shape[2] == x.shape[3], 'batched rotations need square crops'
+    flips = torch.randint(0, 2, (x.size(0),))
+    rots = torch.randint(0, 4, (x.size(0),))
+    out = torch.empty_like(x)
+    for flip in range(2):
+        for k in range(4):
+            index = torch.nonzero((flips == flip) & (rots == k))[:, 0].to(x.device)
+            if len(index):
+                group = x[index].flip(3) if flip else x[index]
+                out[index] = group.rot90(k, (2, 3))
+    return out.split([b.size(1) for b in batches], 1)
+
+
+def normalize_batch(x, clip=True):
+    # uint8 -> float in [0, 1], followed by the CLIP normalization of preprocess_feature for the hazy inputs.
+    x = x.float().div_(255)
+    if clip:
+        mean = torch.tensor(CLIP_MEAN, device=x.device).view(1, 3, 1, 1)
+        std = torch.tensor(CLIP_STD, device=x.device).view(1, 3, 1, 1)
+        x = x.sub_(mean).div_(std)
+    return x
+
+
+def prepare_batch(haze, clear=None, train=True):
+    # Turns a collated raw batch into what the float datasets return: the CLIP-normalized hazy crops and the clear
+    # crops in [0, 1].
+    batches = [haze] if clear is None else [haze, clear]
+    if train:
+        batches = augment_batch(*batches)
+    haze = normalize_batch(batches[0])
+    if clear is None:
+        return haze
+    return haze, normalize_batch(batches[1], clip=False)
@@ -1,43 +1,82 @@
 import os
 import random
+import torch
+import torch.nn.functional as F
 import torch.utils.data as data
 from PIL import Image
 from torchvision.transforms import Normalize, ToTensor, RandomCrop, RandomHorizontalFlip, Resize
 from torchvision.transforms import functional as FF
+from .index import DatasetIndex
+
+
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
 
 
 def preprocess_feature(img):
     img = ToTensor()(img)
-    clip_normalizer = Normalize((0.48145466, 0.4578275, 0.40821073), (0.26862954, 0.26130258, 0.27577711))
+    clip_normalizer = Normalize(CLIP_MEAN, CLIP_STD)
     img = clip_normalizer(img)
     return img
 
 
+def pad_collate(batch):
+    # Collates (hazy, clear, name) samples of different sizes by padding them to the largest one: reflect padding
+    # for the hazy inputs, like pad_img in the training scripts, and zeros for the clear targets. The (N, 1, H, W)
+    # mask marks the valid pixels for metric.MetricAccumulator.
+    h = max(hazy.shape[1] for hazy, _, _ in batch)
+    w = max(hazy.shape[2] for hazy, _, _ in batch)
+    hazys, clears, masks, names = [], [], [], []
+    for hazy, clear, name in batch:
+        pad = (0, w - hazy.shape[2], 0, h - hazy.shape[1])
+        mode = 'reflect' if pad[1] < hazy.shape[2] and pad[3] < hazy.shape[1] else 'replicate'
+        hazys.append(F.pad(hazy.unsqueeze(0), pad, mode)[0])
+        clears.append(F.pad(clear, pad))
+        masks.append(F.pad(torch.ones(1, *hazy.shape[1:]), pad))
+        names.append(name)
+    return torch.stack(hazys), torch.stack(clears), torch.stack(masks), names
+
+
 class RESIDE_Dataset(data.Dataset):
-    def __init__(self, path, train, size=256, format='.png'):
+    def __init__(self, path, train, size=256, format='.png', raw=False, index_file=''):
         super(RESIDE_Dataset, self).__init__()
         self.size = size
         self.train = train
         self.format = format
-        self.haze_imgs_dir = os.listdir(os.path.join(path, 'hazy'))
-        self.haze_imgs = [os.path.join(path, 'hazy', img) for img in self.haze_imgs_dir]
+        self.raw = raw
+        # index_file: built by data.index, replaces the directory listing and the per-sample pairing.
+        self.pairs = DatasetIndex(index_file, path, size) if index_file else None
+        if self.pairs is not None:
+            self.haze_imgs = self.pairs.haze_imgs
+        else:
+            self.haze_imgs_dir = os.listdir(os.path.join(path, 'hazy'))
+            self.haze_imgs = [os.path.join(path, 'hazy', img) for img in self.haze_imgs_dir]
         self.clear_dir = os.path.join(path, 'clear')
 
     def __getitem__(self, index):
-        haze = Image.open(self.haze_imgs[index])
-        if isinstance(self.size, int):
-            while haze.size[0] < self.size or haze.size[1] < self.size:
-                index = random.randint(0, 100)
-                haze = Image.open(self.haze_imgs[index])
-        img = self.haze_imgs[index]
-        split_name = os.path.split(img)[-1].split('_')
-        id = split_name[0]
-        clear_name = id + self.format
-        clear = Image.open(os.path.join(self.clear_dir, clear_name))
+        if self.pairs is not None:
+            # Only entries that fit the crop are used, without opening other images to find one.
+            index = self.pairs.entry(index)
+            haze = Image.open(self.haze_imgs[index])
+            clear = Image.open(self.pairs.clear_imgs[index])
+        else:
+            haze = Image.open(self.haze_imgs[index])
+            if isinstance(self.size, int):
+                while haze.size[0] < self.size or haze.size[1] < self.size:
+                    index = random.randint(0, 100)
+                    haze = Image.open(self.haze_imgs[index])
+            img = self.haze_imgs[index]
+            split_name = os.path.split(img)[-1].split('_')
+            id = split_name[0]
+            clear_name = id + self.format
+            clear = Image.open(os.path.join(self.clear_dir, clear_name))
         if not isinstance(self.size, str):
             i, j, h, w = RandomCrop.get_params(haze, output_size=(self.size, self.size))
             haze = FF.crop(haze, i, j, h, w)
             clear = FF.crop(clear, i, j, h, w)
+        if self.raw:
+            # uint8 crops for data.augment.prepare_batch, which augments and normalizes the collated batch.
+            return FF.pil_to_tensor(haze.convert("RGB")), FF.pil_to_tensor(clear.convert("RGB"))
         haze, clear = self.augData(haze.convert("RGB"), clear.convert("RGB"))
         return haze, clear
 
@@ -58,34 +97,49 @@ class RESIDE_Dataset(data.Dataset):
 
 
 class RESIDE_Dataset_2(data.Dataset):
-    def __init__(self, path, train, size=256, format='.jpg'):
+    def __init__(self, path, train, size=256, format='.jpg', raw=False, index_file=''):
         super(RESIDE_Dataset_2, self).__init__()
         self.size = size
         self.train = train
         self.format = format
-        self.haze_imgs_dir = os.listdir(os.path.join(path, 'hazy'))
-        self.haze_imgs = [os.path.join(path, 'hazy', img) for img in self.haze_imgs_dir]
+        self.raw = raw
+        # index_file: built by data.index, replaces the directory listing and the per-sample pairing.
+        self.pairs = DatasetIndex(index_file, path, size) if index_file else None
+        if self.pairs is not None:
+            self.haze_imgs = self.pairs.haze_imgs
+        else:
+            self.haze_imgs_dir = os.listdir(os.path.join(path, 'hazy'))
+            self.haze_imgs = [os.path.join(path, 'hazy', img) for img in self.haze_imgs_dir]
         self.clear_dir = os.path.join(path, 'clear')
 
     def __getitem__(self, index):
-        haze = Image.open(self.haze_imgs[index])
-        if isinstance(self.size, int):
-            while haze.size[0] < self.size or haze.size[1] < self.size:
-                index = random.randint(0, 100)
-                haze = Image.open(self.haze_imgs[index])
-        img = self.haze_imgs[index]
-        split_name = os.path.split(img)[-1]
-
-
-        id = os.path.splitext(split_name)[0]
-
-
-        clear_name = f"{id}{self.format}"
-        clear = Image.open(os.path.join(self.clear_dir, clear_name))
+        if self.pairs is not None:
+            # Only entries that fit the crop are used, without opening other images to find one.
+            index = self.pairs.entry(index)
+            haze = Image.open(self.haze_imgs[index])
+            clear = Image.open(self.pairs.clear_imgs[index])
+        else:
+            haze = Image.open(self.haze_imgs[index])
+            if isinstance(self.size, int):
+                while haze.size[0] < self.size or haze.size[1] < self.size:
+                    index = random.randint(0, 100)
+                    haze = Image.open(self.haze_imgs[index])
+            img = self.haze_imgs[index]
+            split_name = os.path.split(img)[-1]
+
+
+            id = os.path.splitext(split_name)[0]
+
+
+            clear_name = f"{id}{self.format}"
+            clear = Image.open(os.path.join(self.clear_dir, clear_name))
         if not isinstance(self.size, str):
             i, j, h, w = RandomCrop.get_params(haze, output_size=(self.size, self.size))
             haze = FF.crop(haze, i, j, h, w)
             clear = FF.crop(clear, i, j, h, w)
+        if self.raw:
+            # uint8 crops for data.augment.prepare_batch, which augments and normalizes the collated batch.
+            return FF.pil_to_tensor(haze.convert("RGB")), FF.pil_to_tensor(clear.convert("RGB"))
         haze, clear = self.augData(haze.convert("RGB"), clear.convert("RGB"))
         return haze, clear
 
@@ -147,9 +201,10 @@ class TestDataset(data.Dataset):
 
 class CLIP_loader(data.Dataset):
 
-    def __init__(self, hazy_path, train, size=256):
+    def __init__(self, hazy_path, train, size=256, raw=False):
         self.hazy_path = hazy_path
         self.train = train
+        self.raw = raw
         self.hazy_image_list = os.listdir(hazy_path)
         self.hazy_image_list.sort()
         self.size = size
@@ -165,6 +220,8 @@ class CLIP_loader(data.Dataset):
             i, j, h, w = RandomCrop.get_params(hazy, output_size=(crop_size, crop_size))
             hazy = FF.crop(hazy, i, j, h, w)
         hazy = Resize((self.size, self.size))(hazy)
+        if self.raw:
+            return FF.pil_to_tensor(hazy.convert("RGB"))
         hazy = self.augData(hazy.convert("RGB"))
         return hazy
 
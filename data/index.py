@@ -0,0 +1,85 @@
+import argparse
+import os
+import random
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+
+# Index of a hazy/ + clear/ training tree: the hazy and clear file names of every pair, the usable size (the common
+# top-left size of the two images) and the atmospheric light A / scattering coefficient beta encoded in Haze4K-style
+# names (<id>_<A>_<beta>.png, NaN otherwise). Only the image headers are read, by a process pool. Build it once:
+#   python -m data.index --data ./data/THaze/train --format .jpg --workers 8
+# then pass --data_index ./data/THaze/train/dataset_index.npz to Teacher.py or KD.py.
+
+PAIRINGS = {
+    # RESIDE_Dataset: <id>_<anything>.ext -> <id><format>
+    'id': lambda name, format: name.split('_')[0] + format,
+    # RESIDE_Dataset_2: <stem>.ext -> <stem><format>
+    'stem': lambda name, format: os.path.splitext(name)[0] + format,
+}
+
+
+def clear_name(hazy_name, format, pairing='id'):
+    return PAIRINGS[pairing](hazy_name, format)
+
+
+def haze_params(hazy_name):
+    parts = os.path.splitext(hazy_name)[0].split('_')
+    if len(parts) == 3:
+        try:
+            return float(parts[1]), float(parts[2])
+        except ValueError:
+            pass
+    return float('nan'), float('nan')
+
+
+def pair_size(paths):
+    hazy_path, clear_path = paths
+    with Image.open(hazy_path) as hazy, Image.open(clear_path) as clear:
+        return min(hazy.size[1], clear.size[1]), min(hazy.size[0], clear.size[0])
+
+
+def build_index(path, out_path, format='.png', pairing='id', workers=0):
+    hazy = sorted(os.listdir(os.path.join(path, 'hazy')))
+    clear = [clear_name(name, format, pairing) for name in hazy]
+    pairs = [(os.path.join(path, 'hazy', h), os.path.join(path, 'clear', c)) for h, c in zip(hazy, clear)]
+    with Pool(workers or os.cpu_count()) as pool:
+        sizes = pool.map(pair_size, pairs, chunksize=64)
+    np.savez_compressed(out_path, hazy=np.array(hazy), clear=np.array(clear),
+                        sizes=np.array(sizes, dtype=np.int32).reshape(-1, 2),
+                        params=np.array([haze_params(name) for name in hazy], dtype=np.float32).reshape(-1, 2))
+    return len(hazy)
+
+
+class DatasetIndex(object):
+    # Loaded form of an index for the datasets: full paths, sizes and the entries that fit a crop of `size`.
+    def __init__(self, index_path, path, size):
+        index = np.load(index_path)
+        self.haze_imgs = [os.path.join(path, 'hazy', str(name)) for name in index['hazy']]
+        self.clear_imgs = [os.path.join(path, 'clear', str(name)) for name in index['clear']]
+        self.sizes = index['sizes']
+        self.params = index['params']
+        # A size that is not an int means whole images, which always fit.
+        self.fit = (self.sizes >= size).all(1) if isinstance(size, int) else np.ones(len(self.sizes), dtype=bool)
+        self.valid = np.flatnonzero(self.fit)
+        assert len(self.valid), f'no image of the index is at least {size}x{size}'
+
+    def entry(self, k):
+        # k itself when it fits the crop, otherwise a random entry that does.
+        if not self.fit[k]:
+            k = self.valid[random.randint(0, len(self.valid) - 1)]
+        return k
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='./data/THaze/train')
+    parser.add_argument('--format', type=str, default='.jpg', help='extension of the clear images')
+    parser.add_argument('--pairing', type=str, default='id', choices=list(PAIRINGS),
+                        help='id: RESIDE_Dataset naming, stem: RESIDE_Dataset_2 naming')
+    parser.add_argument('--out', type=str, default='', help='index file, <data>/dataset_index.npz if empty')
+    parser.add_argument('--workers', type=int, default=0, help='header scanning processes, 0 uses every CPU')
+    opt = parser.parse_args()
+
+    out = opt.out or os.path.join(opt.data, 'dataset_index.npz')
+    print(f'{build_index(opt.data, out, opt.format, opt.pairing, opt.workers)} pairs indexed in {out}')
@@ -0,0 +1,116 @@
+import argparse
+import os
+import random
+import numpy as np
+import torch
+import torch.utils.data as data
+from multiprocessing import Pool
+from PIL import Image
+from torchvision.transforms import ToTensor
+from .data_loader import preprocess_feature
+from .index import clear_name, pair_size
+
+# Pre-decoded training set: every hazy/clear pair of a RESIDE-style tree is stored once as uint8 HWC pixels in a
+# single memory-mapped file, so a training sample only reads the pages of its crop instead of decoding two full
+# images. Build it once from the repo root:
+#   python -m data.packed --data ./data/THaze/train --format .jpg --workers 8
+# then train with python Teacher.py --packed ./data/THaze/train/packed (or KD.py)
+#
+# Entry k is pixels[offsets[k]:offsets[k + 1]] viewed as (2, h, w, 3): the hazy image followed by its clear image.
+# A pair whose images differ in size is stored at the common top-left size.
+
+
+_pixels = None
+
+
+def _open_pixels(pixels_path):
+    global _pixels
+    _pixels = np.load(pixels_path, mmap_mode='r+')
+
+
+def _pack_pair(task):
+    k, hazy_path, clear_path, offset, h, w = task
+    entry = _pixels[offset:offset + 2 * h * w * 3].reshape(2, h, w, 3)
+    for n, image_path in enumerate((hazy_path, clear_path)):
+        with Image.open(image_path) as img:
+            entry[n] = np.asarray(img.convert('RGB'))[:h, :w]
+    return k
+
+
+def pack_dataset(path, out_dir, format='.png', workers=0):
+    names = sorted(os.listdir(os.path.join(path, 'hazy')))
+    pairs = [(os.path.join(path, 'hazy', name), os.path.join(path, 'clear', clear_name(name, format)))
+             for name in names]
+    workers = workers or os.cpu_count()
+    with Pool(workers) as pool:
+        sizes = pool.map(pair_size, pairs, chunksize=64)
+    offsets = np.cumsum([0] + [2 * h * w * 3 for h, w in sizes]).astype(np.int64)
+
+    os.makedirs(out_dir, exist_ok=True)
+    pixels_path = os.path.join(out_dir, 'pixels.npy')
+    np.lib.format.open_memmap(pixels_path, mode='w+', dtype=np.uint8, shape=(int(offsets[-1]),)).flush()
+    tasks = [(k, hazy_path, clear_path, offsets[k], h, w) for k, ((hazy_path, clear_path), (h, w))
+             in enumerate(zip(pairs, sizes))]
+    # Every worker maps the file itself and writes its pairs in place, so decoded pixels never go through a pipe.
+    with Pool(workers, initializer=_open_pixels, initargs=(pixels_path,)) as pool:
+        for done, k in enumerate(pool.imap_unordered(_pack_pair, tasks, chunksize=4)):
+            print(f'\r{done + 1}/{len(tasks)} {names[k]}', end='', flush=True)
+    np.savez(os.path.join(out_dir, 'index.npz'), names=np.array(names), offsets=offsets, sizes=np.array(sizes))
+    print()
+
+
+class PackedDataset(data.Dataset):
+    # Same samples as RESIDE_Dataset, read from a pack built by pack_dataset. Images smaller than the crop are
+    # replaced by a random image that fits.
+    def __init__(self, pack_dir, train, size=256, raw=False):
+        super(PackedDataset, self).__init__()
+        self.size = size
+        self.train = train
+        self.raw = raw
+        index = np.load(os.path.join(pack_dir, 'index.npz'))
+        self.names = [str(name) for name in index['names']]
+        self.offsets = index['offsets']
+        self.sizes = index['sizes']
+        self.valid = np.flatnonzero((self.sizes[:, 0] >= size) & (self.sizes[:, 1] >= size))
+        assert len(self.valid), f'no image of the pack is at least {size}x{size}'
+        self.pixels_path = os.path.join(pack_dir, 'pixels.npy')
+        self.pixels = None
+
+    def __getitem__(self, index):
+        # Opened lazily so that every DataLoader worker maps the file itself.
+        if self.pixels is None:
+            self.pixels = np.load(self.pixels_path, mmap_mode='r')
+        h, w = self.sizes[index]
+        if h < self.size or w < self.size:
+            index = self.valid[random.randint(0, len(self.valid) - 1)]
+            h, w = self.sizes[index]
+        i = random.randint(0, h - self.size)
+        j = random.randint(0, w - self.size)
+        entry = self.pixels[self.offsets[index]:self.offsets[index + 1]].reshape(2, h, w, 3)
+        haze, clear = entry[:, i:i + self.size, j:j + self.size]
+        if self.raw:
+            return tuple(torch.from_numpy(np.ascontiguousarray(t.transpose(2, 0, 1))) for t in (haze, clear))
+        if self.train:
+            # np.rot90 over (H, W) turns counter-clockwise like FF.rotate in RESIDE_Dataset.augData.
+            rand_hor = random.randint(0, 1)
+            rand_rot = random.randint(0, 3)
+            if rand_hor:
+                haze, clear = haze[:, ::-1], clear[:, ::-1]
+            if rand_rot:
+                haze, clear = np.rot90(haze, rand_rot), np.rot90(clear, rand_rot)
+        haze, clear = np.ascontiguousarray(haze), np.ascontiguousarray(clear)
+        return preprocess_feature(haze), ToTensor()(clear)
+
+    def __len__(self):
+        return len(self.names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='./data/THaze/train')
+    parser.add_argument('--format', type=str, default='.jpg', help='extension of the clear images')
+    parser.add_argument('--out', type=str, default='', help='pack directory, <data>/packed if empty')
+    parser.add_argument('--workers', type=int, default=0, help='packing processes, 0 uses every CPU')
+    opt = parser.parse_args()
+
+    pack_dataset(opt.data, opt.out or os.path.join(opt.data, 'packed'), opt.format, opt.workers)
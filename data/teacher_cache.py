@@ -0,0 +1,131 @@
+import argparse
+import os
+import random
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+from torchvision.transforms import ToTensor
+from torchvision.transforms import functional as FF
+from .data_loader import preprocess_feature
+
+# Offline cache of the frozen Teacher for KD.py: the dehazed output and the four distillation features of every
+# training image, stored as float16 in a single memory-mapped file. Build it once from the repo root:
+#   python -m data.teacher_cache --data ./data/THaze/train --weights ./model/Teacher_model/Teacher.pth
+# then train with python KD.py --teacher_cache ./data/THaze/train/teacher_cache
+#
+# The Teacher sees the whole image (cropped to a multiple of 16), so the cached features of a crop carry the
+# context of the full image instead of the zero/reflect padding at the crop border.
+
+STRIDE = 16
+# (channels, downscale) of the Teacher output and of its features [H4, H3, H2, H1].
+LAYOUT = [(3, 1), (16, 2), (32, 4), (64, 8), (128, 16)]
+
+
+def entry_size(h, w):
+    return sum(c * (h // s) * (w // s) for c, s in LAYOUT)
+
+
+def build_teacher_cache(model, path, cache_dir, device):
+    hazy_dir = os.path.join(path, 'hazy')
+    names = sorted(os.listdir(hazy_dir))
+    sizes = []
+    for name in names:
+        with Image.open(os.path.join(hazy_dir, name)) as img:
+            w, h = img.size
+        sizes.append((h // STRIDE * STRIDE, w // STRIDE * STRIDE))
+    offsets = np.cumsum([0] + [entry_size(h, w) for h, w in sizes]).astype(np.int64)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    cache = np.lib.format.open_memmap(os.path.join(cache_dir, 'teacher.npy'), mode='w+', dtype=np.float16,
+                                      shape=(int(offsets[-1]),))
+    model.eval()
+    for k, (name, (h, w)) in enumerate(zip(names, sizes)):
+        if h == 0 or w == 0:
+            continue
+        haze = Image.open(os.path.join(hazy_dir, name)).convert('RGB').crop((0, 0, w, h))
+        with torch.no_grad():
+            out, feats = model(preprocess_feature(haze).unsqueeze(0).to(device))
+        values = torch.cat([t.flatten() for t in [out] + feats]).half().cpu().numpy()
+        cache[offsets[k]:offsets[k + 1]] = values
+        print(f'\r{k + 1}/{len(names)} {name} {h}x{w}', end='', flush=True)
+    cache.flush()
+    np.savez(os.path.join(cache_dir, 'index.npz'), names=np.array(names), offsets=offsets, sizes=np.array(sizes))
+    print()
+
+
+class TeacherCacheDataset(data.Dataset):
+    # Same samples as RESIDE_Dataset, plus the cached Teacher output and features of the crop. Crops start on
+    # the 16-pixel grid so that every feature map is sliced exactly, and the flips/rotations are applied to the
+    # image and to the features alike.
+    def __init__(self, path, cache_dir, train, size=256, format='.png'):
+        super(TeacherCacheDataset, self).__init__()
+        assert size % STRIDE == 0, f'crop size must be a multiple of {STRIDE}'
+        self.size = size
+        self.train = train
+        self.format = format
+        index = np.load(os.path.join(cache_dir, 'index.npz'))
+        self.haze_imgs = [os.path.join(path, 'hazy', str(name)) for name in index['names']]
+        self.offsets = index['offsets']
+        self.sizes = index['sizes']
+        self.clear_dir = os.path.join(path, 'clear')
+        self.cache_path = os.path.join(cache_dir, 'teacher.npy')
+        self.cache = None
+
+    def cached(self, index, i, j):
+        # Opened lazily so that every DataLoader worker maps the file itself.
+        if self.cache is None:
+            self.cache = np.load(self.cache_path, mmap_mode='r')
+        h, w = self.sizes[index]
+        offset = self.offsets[index]
+        tensors = []
+        for c, s in LAYOUT:
+            n = c * (h // s) * (w // s)
+            t = self.cache[offset:offset + n].reshape(c, h // s, w // s)
+            t = t[:, i // s:(i + self.size) // s, j // s:(j + self.size) // s]
+            tensors.append(torch.from_numpy(np.ascontiguousarray(t)))
+            offset += n
+        return tensors
+
+    def __getitem__(self, index):
+        while self.sizes[index][0] < self.size or self.sizes[index][1] < self.size:
+            index = random.randint(0, len(self) - 1)
+        h, w = self.sizes[index]
+        i = random.randint(0, (h - self.size) // STRIDE) * STRIDE
+        j = random.randint(0, (w - self.size) // STRIDE) * STRIDE
+        id = os.path.split(self.haze_imgs[index])[-1].split('_')[0]
+        haze = Image.open(self.haze_imgs[index]).convert('RGB')
+        clear = Image.open(os.path.join(self.clear_dir, id + self.format)).convert('RGB')
+        haze = FF.crop(haze, i, j, self.size, self.size)
+        clear = FF.crop(clear, i, j, self.size, self.size)
+        tensors = [preprocess_feature(haze), ToTensor()(clear)] + self.cached(index, i, j)
+        if self.train:
+            # torch.rot90 over (H, W) turns counter-clockwise like FF.rotate in RESIDE_Dataset.augData.
+            rand_hor = random.randint(0, 1)
+            rand_rot = random.randint(0, 3)
+            if rand_hor:
+                tensors = [t.flip(2) for t in tensors]
+            if rand_rot:
+                tensors = [t.rot90(rand_rot, (1, 2)) for t in tensors]
+            tensors = [t.contiguous() for t in tensors]
+        haze, clear, teacher_out = tensors[:3]
+        return haze, clear, teacher_out, tensors[3:]
+
+    def __len__(self):
+        return len(self.haze_imgs)
+
+
+if __name__ == '__main__':
+    from model import Teacher
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='./data/THaze/train')
+    parser.add_argument('--weights', type=str, default='./model/Teacher_model/Teacher.pth')
+    parser.add_argument('--out', type=str, default='', help='cache directory, <data>/teacher_cache if empty')
+    opt = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher_net = Teacher().to(device)
+    teacher_net.load_state_dict(torch.load(opt.weights, map_location=torch.device("cpu")))
+    teacher_net.switch_to_deploy()
+    build_teacher_cache(teacher_net, opt.data, opt.out or os.path.join(opt.data, 'teacher_cache'), device)
@@ -0,0 +1,113 @@
+import queue
+import random
+from contextlib import contextmanager
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+# Runs the frozen teacher of KD.py / EMA.py in a separate process: the producer iterates the training DataLoader,
+# runs the teacher on each batch and puts the batch together with the teacher outputs in a bounded queue, so the
+# pairing of inputs and teacher outputs never depends on queue order. Tensors go through shared memory.
+#
+# The teacher parameters are shared with the producer. EMA.py updates them in place inside update(): the
+# producer holds the same lock during every teacher forward and tags its outputs with the weight version, and
+# outputs computed with older weights are recomputed here when they are dequeued.
+
+
+def _batch_input(batch):
+    return batch[0] if isinstance(batch, (list, tuple)) else batch
+
+
+def _teacher_forward(model, x, device, features, amp_dtype):
+    with torch.no_grad(), torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        return model(x.to(device), features=features)
+
+
+def _produce(model, dataset, loader_kwargs, device, features, amp_dtype, threads, seed, out_queue, version, stop):
+    # The spawned process starts with fresh RNGs: seeded from the training process, so its shuffling and
+    # augmentation follow set_seed_torch and a resumed RNG state.
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    if threads:
+        torch.set_num_threads(threads)
+    loader = DataLoader(dataset, **loader_kwargs)
+    while not stop.is_set():
+        for batch in loader:
+            with version.get_lock():
+                v = version.value
+                out = _teacher_forward(model, _batch_input(batch), device, features, amp_dtype)
+            while not stop.is_set():
+                try:
+                    out_queue.put((batch, out, v), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if stop.is_set():
+                break
+
+
+class TeacherWorker(object):
+    # Drop-in replacement for the training DataLoader: iterating it yields the loader batch followed by the
+    # teacher output, i.e. (x, y, out, feats) with features=True and (x, out) with features=False.
+    def __init__(self, model, dataset, loader_kwargs, device, features=True, depth=4, threads=0, amp_dtype=None):
+        ctx = mp.get_context('spawn')
+        self.model = model.eval().share_memory()
+        self.device = torch.device(device)
+        self.features = features
+        self.amp_dtype = amp_dtype
+        self.length = len(DataLoader(dataset, **loader_kwargs))
+        self.version = ctx.Value('i', 0)
+        self.queue = ctx.Queue(depth)
+        self.stop = ctx.Event()
+        self.ctx = ctx
+        self.args = (self.model, dataset, loader_kwargs, self.device, features, amp_dtype, threads)
+        self.process = None
+
+    def __iter__(self):
+        # The training loops re-create their iterator at every epoch; the producer already runs over epochs. It is
+        # started by the first iter(), after KD.py / EMA.py have seeded or restored the torch RNG it is seeded from.
+        if self.process is None:
+            seed = int(torch.randint(0, 2 ** 62, (1,)).item())
+            self.process = self.ctx.Process(target=_produce,
+                                            args=self.args + (seed, self.queue, self.version, self.stop))
+            self.process.start()
+        return self
+
+    def __len__(self):
+        return self.length
+
+    def __next__(self):
+        while True:
+            try:
+                batch, out, v = self.queue.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError(f'teacher worker exited with code {self.process.exitcode}')
+        # Only update() writes the version, from this process, so it is read without the lock that the producer
+        # holds during its teacher forward.
+        if v != self.version.get_obj().value:
+            out = _teacher_forward(self.model, _batch_input(batch), self.device, self.features, self.amp_dtype)
+        batch = list(batch) if isinstance(batch, (list, tuple)) else [batch]
+        return tuple(batch + (list(out) if self.features else [out]))
+
+    @contextmanager
+    def update(self):
+        # Wrap every in-place update of the teacher weights.
+        with self.version.get_lock():
+            yield
+            self.version.value += 1
+
+    def close(self):
+        if self.process is None:
+            return
+        self.stop.set()
+        while self.process.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.process.join()
+
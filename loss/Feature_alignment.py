@@ -64,6 +64,9 @@ class FA(nn.Module):
         self.gaussian_loss_fn = GaussianLoss()
 
     def forward(self, teacher_feats, student_feats):
+        # The softmax distributions and variances are computed in fp32 even under autocast.
+        teacher_feats = [f.float() for f in teacher_feats]
+        student_feats = [f.float() for f in student_feats]
         num_layers = len(teacher_feats)
         attention_weights = compute_attention_weights(teacher_feats, student_feats)
         total_loss = 0.0
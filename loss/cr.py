@@ -32,41 +32,49 @@ class Vgg19(torch.nn.Module):
             for param in self.parameters():
                 param.requires_grad = False
 
-    def forward(self, X):
-        h_relu1 = self.slice1(X)
-        h_relu2 = self.slice2(h_relu1)
-        h_relu3 = self.slice3(h_relu2)
-        h_relu4 = self.slice4(h_relu3)
-        h_relu5 = self.slice5(h_relu4)
-        return [h_relu1, h_relu2, h_relu3, h_relu4, h_relu5]
+    def forward(self, X, depth=5):
+        # Only the first `depth` slices are computed.
+        outs = []
+        for layer in [self.slice1, self.slice2, self.slice3, self.slice4, self.slice5][:depth]:
+            X = layer(X)
+            outs.append(X)
+        return outs
 
 
 class ContrastLoss(nn.Module):
-    def __init__(self, ablation=False):
+    def __init__(self, ablation=False, weights=None):
 
         super(ContrastLoss, self).__init__()
-        self.vgg = Vgg19().cuda()
+        self.vgg = Vgg19()
         self.l1 = nn.L1Loss()
-        self.weights = [1.0 / 32, 1.0 / 16, 1.0 / 8, 1.0 / 4, 1.0]
+        self.weights = weights if weights is not None else [1.0 / 32, 1.0 / 16, 1.0 / 8, 1.0 / 4, 1.0]
         self.ab = ablation
-        self.mean = torch.tensor([0.485, 0.456, 0.406]).view(1, -1, 1, 1).cuda()
-        self.std = torch.tensor([0.229, 0.224, 0.225]).view(1, -1, 1, 1).cuda()
+        # VGG slices after the last non-zero weight are never computed; with no non-zero weight none is.
+        self.depth = max((i + 1 for i, w in enumerate(self.weights) if w != 0), default=0)
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, -1, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, -1, 1, 1))
 
     def forward(self, a, p, n):
-        a = (a - self.mean) / self.std
-        p = (p - self.mean) / self.std
-        n = (n - self.mean) / self.std
-        a_vgg, p_vgg, n_vgg = self.vgg(a), self.vgg(p), self.vgg(n)
+        if self.depth == 0:
+            return a.new_zeros(())
+        a_vgg = self.vgg((a - self.mean) / self.std, self.depth)
+        # The positive and negative are only targets: one batched pass without autograd. no_grad rather than
+        # inference_mode, since L1 saves its inputs for the backward of a.
+        with torch.no_grad():
+            targets = p if self.ab else torch.cat([p, n])
+            t_vgg = self.vgg((targets - self.mean) / self.std, self.depth)
         loss = 0
 
-        d_ap, d_an = 0, 0
-        for i in range(len(a_vgg)):
-            d_ap = self.l1(a_vgg[i], p_vgg[i].detach())
+        for i in range(self.depth):
+            if self.weights[i] == 0:
+                continue
             if not self.ab:
-                d_an = self.l1(a_vgg[i], n_vgg[i].detach())
+                p_vgg, n_vgg = t_vgg[i].chunk(2)
+                d_ap = self.l1(a_vgg[i], p_vgg)
+                d_an = self.l1(a_vgg[i], n_vgg)
                 contrastive = d_ap / (d_an + 1e-7)
             else:
-                contrastive = d_ap
+                contrastive = self.l1(a_vgg[i], t_vgg[i])
 
             loss += self.weights[i] * contrastive
         return loss
@@ -1 +1,2 @@
-from .metric import psnr, ssim
\ No newline at end of file
+from .metric import psnr, ssim, structural_similarity, batch_psnr, MetricAccumulator
+from .eval_worker import EvalWorker
\ No newline at end of file
@@ -0,0 +1,115 @@
+import copy
+import os
+import queue
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from data import pad_collate
+from utils import snapshot_state_dict, atomic_save
+from .metric import MetricAccumulator
+
+# Evaluates weight snapshots in a separate process while training goes on. The test set is decoded once and kept
+# in memory (so TestDataset's random 256 crops are drawn once for the whole run). For every snapshot the worker
+# appends the usual line to log.txt, saves best.pth when the PSNR improves and sends (step, ssim, psnr) back.
+# Snapshots are evaluated in submission order; submit() blocks when `depth` snapshots are already waiting.
+
+
+def _pad_img(x, patch_size):
+    _, _, h, w = x.size()
+    mod_pad_h = (patch_size - h % patch_size) % patch_size
+    mod_pad_w = (patch_size - w % patch_size) % patch_size
+    return F.pad(x, (0, mod_pad_w, 0, mod_pad_h), 'reflect')
+
+
+def _evaluate(model, batches, device, amp_dtype):
+    metrics = MetricAccumulator()
+    with torch.no_grad():
+        for inputs, targets, masks, _ in batches:
+            inputs, targets, masks = inputs.to(device), targets.to(device), masks.to(device)
+            H, W = inputs.shape[2:]
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                pred = model(_pad_img(inputs, 4), features=False)
+            pred = pred.float().clamp(0, 1)[:, :, :H, :W]
+            metrics.update(pred, targets, masks)
+    return metrics.compute()
+
+
+def _run(model, test_set, batch_size, device, amp_dtype, saved_model_dir, saved_data_dir, max_ssim, max_psnr, in_queue,
+         out_queue):
+    samples = [test_set[i] for i in range(len(test_set))]
+    batches = [pad_collate(samples[i:i + batch_size]) for i in range(0, len(samples), batch_size)]
+    model = model.to(device).eval()
+    while True:
+        item = in_queue.get()
+        if item is None:
+            break
+        step, epoch, extra, state_dict = item
+        model.load_state_dict(state_dict)
+        ssim_eval, psnr_eval = _evaluate(model, batches, device, amp_dtype)
+
+        log = f'\nstep :{step} | epoch: {epoch} | ssim:{ssim_eval:.4f}| psnr:{psnr_eval:.4f} | {extra}'
+        print(log)
+        with open(os.path.join(saved_data_dir, 'log.txt'), 'a') as f:
+            f.write(log + '\n')
+        if psnr_eval > max_psnr:
+            max_ssim = max(max_ssim, ssim_eval)
+            max_psnr = max(max_psnr, psnr_eval)
+            print(f'model saved at step :{step}| epoch: {epoch} | max_psnr:{max_psnr:.4f}| max_ssim:{max_ssim:.4f}')
+            atomic_save(state_dict, os.path.join(saved_model_dir, 'best.pth'))
+        out_queue.put((step, ssim_eval, psnr_eval))
+
+
+class EvalWorker(object):
+    def __init__(self, model, test_set, batch_size, device, saved_model_dir, saved_data_dir, amp_dtype=None, depth=2,
+                 max_ssim=0, max_psnr=0):
+        # max_ssim / max_psnr: best results so far when training is resumed, so best.pth is only replaced by a
+        # better snapshot.
+        ctx = mp.get_context('spawn')
+        # The worker gets its own copy: tensors passed to the process are shared, and it loads every snapshot into
+        # its model in place.
+        model = copy.deepcopy(model).cpu()
+        self.in_queue = ctx.Queue(depth)
+        self.out_queue = ctx.Queue()
+        self.process = ctx.Process(target=_run, args=(model, test_set, batch_size, torch.device(device), amp_dtype,
+                                                      saved_model_dir, saved_data_dir, max_ssim, max_psnr,
+                                                      self.in_queue, self.out_queue),
+                                   daemon=True)
+        self.process.start()
+        self.pending = 0
+
+    def submit(self, step, epoch, extra, state_dict):
+        # `extra` is the end of the log line (lr, amp, throughput). The state dict is copied to CPU here, so
+        # training can update the weights right away.
+        # A dead worker would never empty the queue, so liveness is checked while waiting for a free slot.
+        self._check_alive()
+        item = (step, epoch, extra, snapshot_state_dict(state_dict))
+        while True:
+            try:
+                self.in_queue.put(item, timeout=1)
+                break
+            except queue.Full:
+                self._check_alive()
+        self.pending += 1
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            raise RuntimeError(f'eval worker exited with code {self.process.exitcode}')
+
+    def poll(self, block=False):
+        results = []
+        while self.pending:
+            try:
+                results.append(self.out_queue.get(block=block, timeout=1 if block else None))
+                self.pending -= 1
+            except queue.Empty:
+                self._check_alive()
+                if not block:
+                    break
+        return results
+
+    def close(self):
+        # Waits for the snapshots still queued and returns their results.
+        results = self.poll(block=True)
+        self.in_queue.put(None)
+        self.process.join()
+        return results
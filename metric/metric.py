@@ -3,7 +3,9 @@ from math import exp
 import numpy as np
 import torch
 import torch.nn.functional as F
-from torch.autograd import Variable
+
+
+_window_cache = {}
 
 
 def gaussian(window_size, sigma):
@@ -11,47 +13,101 @@ def gaussian(window_size, sigma):
     return gauss / gauss.sum()
 
 
-def create_window(window_size, channel):
-    _1D_window = gaussian(window_size, 1.5).unsqueeze(1)
-    _2D_window = _1D_window.mm(_1D_window.t()).float().unsqueeze(0).unsqueeze(0)
-    window = Variable(_2D_window.expand(channel, 1, window_size, window_size).contiguous())
-    return window
-
-
-def _ssim(img1, img2, window, window_size, channel, size_average=True):
-    mu1 = F.conv2d(img1, window, padding=window_size // 2, groups=channel)
-    mu2 = F.conv2d(img2, window, padding=window_size // 2, groups=channel)
-    mu1_sq = mu1.pow(2)
-    mu2_sq = mu2.pow(2)
-    mu1_mu2 = mu1 * mu2
-    sigma1_sq = F.conv2d(img1 * img1, window, padding=window_size // 2, groups=channel) - mu1_sq
-    sigma2_sq = F.conv2d(img2 * img2, window, padding=window_size // 2, groups=channel) - mu2_sq
-    sigma12 = F.conv2d(img1 * img2, window, padding=window_size // 2, groups=channel) - mu1_mu2
-    C1 = 0.01 ** 2
-    C2 = 0.03 ** 2
-    ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
-    if size_average:
-        return ssim_map.mean()
-    else:
-        return ssim_map.mean(1).mean(1).mean(1)
+def separable_window(window_size, channels, dtype, device):
+    # Horizontal and vertical 1D Gaussian kernels for a depthwise conv over `channels` channels. Their product is
+    # the 11x11 window of the original SSIM, and with zero padding the two 1D passes give the same result.
+    key = (window_size, channels, dtype, device)
+    if key not in _window_cache:
+        g = gaussian(window_size, 1.5).to(device=device, dtype=dtype)
+        _window_cache[key] = (g.view(1, 1, 1, -1).expand(channels, 1, 1, window_size).contiguous(),
+                              g.view(1, 1, -1, 1).expand(channels, 1, window_size, 1).contiguous())
+    return _window_cache[key]
+
+
+def structural_similarity(img1, img2, window_size=11, size_average=True, mask=None):
+    # SSIM engine of both the training loss (loss.SSIM) and the metric. The five local statistics are filtered
+    # by one pair of grouped 1D convs. The variances are differences of nearly equal terms, so SSIM always runs in
+    # fp32, also under autocast. Returns the mean over the batch, or one value per image. With a (N, 1, H, W)
+    # mask of the valid pixels of zero-padded images, each image is averaged over its own pixels only: the zeros
+    # around it play the role of the conv zero padding, so the result matches the unpadded image.
+    with torch.autocast(device_type=img1.device.type, enabled=False):
+        img1, img2 = img1.float(), img2.float()
+        channel = img1.shape[1]
+        horizontal, vertical = separable_window(window_size, 5 * channel, img1.dtype, img1.device)
+        stats = torch.cat([img1, img2, img1 * img1, img2 * img2, img1 * img2], dim=1)
+        stats = F.conv2d(stats, horizontal, padding=(0, window_size // 2), groups=5 * channel)
+        stats = F.conv2d(stats, vertical, padding=(window_size // 2, 0), groups=5 * channel)
+        mu1, mu2, e11, e22, e12 = stats.split(channel, dim=1)
+        mu1_sq = mu1.pow(2)
+        mu2_sq = mu2.pow(2)
+        mu1_mu2 = mu1 * mu2
+        sigma1_sq = e11 - mu1_sq
+        sigma2_sq = e22 - mu2_sq
+        sigma12 = e12 - mu1_mu2
+        C1 = 0.01 ** 2
+        C2 = 0.03 ** 2
+        ssim_map = ((2 * mu1_mu2 + C1) * (2 * sigma12 + C2)) / ((mu1_sq + mu2_sq + C1) * (sigma1_sq + sigma2_sq + C2))
+        if mask is not None:
+            per_image = (ssim_map * mask).sum((1, 2, 3)) / (mask.sum((1, 2, 3)) * channel)
+            return per_image.mean() if size_average else per_image
+        if size_average:
+            return ssim_map.mean()
+        else:
+            return ssim_map.mean(1).mean(1).mean(1)
 
 
 def ssim(img1, img2, window_size=11, size_average=True):
     img1 = torch.clamp(img1, min=0, max=1)
     img2 = torch.clamp(img2, min=0, max=1)
-    (_, channel, _, _) = img1.size()
-    window = create_window(window_size, channel)
-    if img1.is_cuda:
-        window = window.cuda(img1.get_device())
-    window = window.type_as(img1)
-    return _ssim(img1, img2, window, window_size, channel, size_average)
+    return structural_similarity(img1, img2, window_size, size_average)
 
 
 def psnr(pred, gt):
-    pred = pred.clamp(0, 1).cpu().numpy()
-    gt = gt.clamp(0, 1).cpu().numpy()
+    pred = pred.float().clamp(0, 1).cpu().numpy()
+    gt = gt.float().clamp(0, 1).cpu().numpy()
     imdff = pred - gt
     rmse = math.sqrt(np.mean(imdff ** 2))
     if rmse == 0:
         return 100
-    return 20 * math.log10(1.0 / rmse)
\ No newline at end of file
+    return 20 * math.log10(1.0 / rmse)
+
+
+def batch_psnr(pred, gt, mask=None):
+    # One PSNR per image, on the tensors' device. Same conventions as psnr: inputs clamped to [0, 1], 100 for
+    # identical images.
+    diff = (pred.float().clamp(0, 1) - gt.float().clamp(0, 1)).pow(2)
+    if mask is None:
+        mse = diff.mean((1, 2, 3))
+    else:
+        mse = (diff * mask).sum((1, 2, 3)) / (mask.sum((1, 2, 3)) * diff.shape[1])
+    return torch.where(mse == 0, torch.full_like(mse, 100), 10 * torch.log10(1 / mse))
+
+
+class MetricAccumulator(object):
+    # Running PSNR/SSIM sums kept on the device of the predictions, so an evaluation loop syncs with the host once,
+    # in compute(). update() takes batches, with an optional mask of the valid pixels of padded images.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.psnr_sum = 0
+        self.ssim_sum = 0
+        self.count = 0
+
+    def update(self, pred, gt, mask=None):
+        pred = pred.float().clamp(0, 1)
+        gt = gt.float().clamp(0, 1)
+        if mask is not None:
+            pred = pred * mask
+            gt = gt * mask
+        self.psnr_sum = self.psnr_sum + batch_psnr(pred, gt, mask).sum()
+        self.ssim_sum = self.ssim_sum + structural_similarity(pred, gt, size_average=False, mask=mask).sum()
+        self.count += pred.shape[0]
+
+    def compute(self):
+        # (ssim, psnr), averaged over the images like the per-image loops of the training scripts; nan for an empty
+        # test set, as np.mean of those loops gave.
+        if self.count == 0:
+            return float('nan'), float('nan')
+        ssim_mean, psnr_mean = (torch.stack([self.ssim_sum, self.psnr_sum]) / self.count).tolist()
+        return ssim_mean, psnr_mean
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops.layers.torch import Rearrange
+from .input_norm import InputNormalize
+import functools
 import math
 
 
@@ -108,6 +110,8 @@ class Decoder_MDCBlock1(torch.nn.Module):
                     len(ft_l_list) - i - 1]
 
         if self.mode == 'iter2':
+            # Each chain starts from the fusion result of the previous one, so unlike iter1/iter4 nothing can be
+            # shared between chains: see benchmark/mdc.py for the cost of this mode.
             ft_fusion = ft_h
             for i in range(len(ft_l_list)):
                 ft = ft_fusion
@@ -131,12 +135,14 @@ class Decoder_MDCBlock1(torch.nn.Module):
                 ft_fusion = ft_fusion + ft
 
         if self.mode == 'iter4':
+            # Every chain starts from ft_h, so the down-sampled features of the shorter chains are prefixes
+            # of the longest one and are computed once.
+            ft_downs = [ft_h]
+            for j in range(self.num_ft):
+                ft_downs.append(self.down_convs[j](ft_downs[-1]))
             ft_fusion = ft_h
             for i in range(len(ft_l_list)):
-                ft = ft_h
-                for j in range(self.num_ft - i):
-                    ft = self.down_convs[j](ft)
-                ft = ft - ft_l_list[i]
+                ft = ft_downs[self.num_ft - i] - ft_l_list[i]
                 for j in range(self.num_ft - i):
                     ft = self.up_convs[self.num_ft - i - j - 1](ft)
                 ft_fusion = ft_fusion + ft
@@ -175,6 +181,8 @@ class Encoder_MDCBlock1(torch.nn.Module):
                     len(ft_h_list) - i - 1]
 
         if self.mode == 'iter2':
+            # Each chain starts from the fusion result of the previous one, so unlike iter1/iter4 nothing can be
+            # shared between chains: see benchmark/mdc.py for the cost of this mode.
             ft_fusion = ft_l
             for i in range(len(ft_h_list)):
                 ft = ft_fusion
@@ -199,14 +207,15 @@ class Encoder_MDCBlock1(torch.nn.Module):
                 ft_fusion = ft_fusion + ft
 
         if self.mode == 'iter4':
+            # Every chain starts from ft_l, so the up-sampled features of the shorter chains are prefixes
+            # of the longest one and are computed once.
+            ft_ups = [ft_l]
+            for j in range(self.num_ft):
+                ft_ups.append(self.up_convs[j](ft_ups[-1]))
             ft_fusion = ft_l
             for i in range(len(ft_h_list)):
-                ft = ft_l
+                ft = ft_ups[self.num_ft - i] - ft_h_list[i]
                 for j in range(self.num_ft - i):
-                    ft = self.up_convs[j](ft)
-                ft = ft - ft_h_list[i]
-                for j in range(self.num_ft - i):
-                    # print(j)
                     ft = self.down_convs[self.num_ft - i - j - 1](ft)
                 ft_fusion = ft_fusion + ft
 
@@ -237,9 +246,25 @@ class RDB(nn.Module):
             nChannels_ += growthRate
         self.dense_layers = nn.Sequential(*modules)
         self.conv_1x1 = nn.Conv2d(nChannels_, nChannels, kernel_size=1, padding=0, bias=False)
+        self.preallocate = True
+
+    def dense_forward(self, x):
+        # Every dense layer writes its growth channels into a slice of one buffer instead of concatenating
+        # the whole growing feature map. The in-place writes are only valid when autograd is off.
+        out = x.new_empty(x.shape[0], self.conv_1x1.in_channels, x.shape[2], x.shape[3])
+        channels = x.shape[1]
+        out[:, :channels] = x
+        for layer in self.dense_layers:
+            growth = layer.conv.out_channels
+            out[:, channels:channels + growth] = F.relu(layer.conv(out[:, :channels]), inplace=True)
+            channels += growth
+        return out
 
     def forward(self, x):
-        out = self.dense_layers(x)
+        if self.preallocate and not torch.is_grad_enabled():
+            out = self.dense_forward(x)
+        else:
+            out = self.dense_layers(x)
         out = self.conv_1x1(out) * self.scale
         out = out + x
         return out
@@ -258,19 +283,56 @@ class ConvLayer(nn.Module):
         return out
 
 
+@functools.lru_cache(maxsize=64)
+def resample_taps(size_in, size_mid, size_out, device):
+    # Per-axis taps of nearest-exact (size_in -> size_mid) followed by bilinear (size_mid -> size_out). The
+    # weights are obtained by resampling an identity matrix with F.interpolate itself, so the source indices
+    # and lambdas are exactly the ones of the two-step resample. Bounded, as Eval.py, Serve.py and tiled
+    # inference see arbitrary input sizes.
+    eye = torch.eye(size_in, device=device).view(1, 1, size_in, size_in)
+    eye = F.interpolate(eye, size=(size_mid, size_in), mode="nearest-exact")
+    matrix = F.interpolate(eye, size=(size_out, size_in), mode='bilinear')[0, 0]
+    weights, index = matrix.topk(int((matrix != 0).sum(1).max()), dim=1)
+    return weights, index
+
+
+def resample(x, size_mid, size_out):
+    for dim in (2, 3):
+        weights, index = resample_taps(x.shape[dim], size_mid[dim - 2], size_out[dim - 2], x.device)
+        shape = [1, 1, 1, 1]
+        shape[dim] = -1
+        out = 0
+        for k in range(index.shape[1]):
+            out = out + x.index_select(dim, index[:, k]) * weights[:, k].view(shape).to(x.dtype)
+        x = out
+    return x
+
+
 class UpsampleConvLayer(torch.nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride):
         super(UpsampleConvLayer, self).__init__()
         self.stride = stride
         self.kernel_size = kernel_size
         self.conv2d = nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1)
+        self.fused = True
 
-    def forward(self, x):
+    def forward(self, x, size=None):
+        # With size, the output is also bilinearly resized to it, as the decoders do to match the skip connection.
         h = (x.shape[2] - 1) * self.stride + self.kernel_size
         w = (x.shape[3] - 1) * self.stride + self.kernel_size
-        x = F.interpolate(x, size=(h, w), mode="nearest-exact")
+        if not self.fused:
+            x = F.interpolate(x, size=(h, w), mode="nearest-exact")
+            out = self.conv2d(x)
+            if size is not None:
+                out = F.interpolate(out, size, mode='bilinear')
+            return out
+
+        # The 1x1 conv commutes with nearest upsampling, so it runs at the input resolution, and the nearest and
+        # bilinear resamples are merged into a single pass over precomputed taps.
         out = self.conv2d(x)
-        return out
+        if size is None:
+            return F.interpolate(out, size=(h, w), mode="nearest-exact")
+        return resample(out, (h, w), tuple(size))
 
 
 def default_conv(in_channels, out_channels, kernel_size, bias=True):
@@ -295,6 +357,7 @@ class ResidualBlock(torch.nn.Module):
 class Student_x(nn.Module):
     def __init__(self, res_blocks=1):
         super(Student_x, self).__init__()
+        self.input_norm = nn.Identity()
         self.conv_input = ConvLayer(3, 8, kernel_size=11, stride=1)
         self.dense0 = nn.Sequential(
             ResidualBlock(8)
@@ -359,8 +422,22 @@ class Student_x(nn.Module):
 
         self.conv_output = ConvLayer(8, 3, kernel_size=3, stride=1)
 
-    def forward(self, x):
-        ini = x
+    def set_input_normalization(self, enabled=True):
+        # enabled: the model takes uint8 (0-255) images and normalizes them itself instead of the data loader.
+        weight = self.conv_input.conv2d.weight
+        self.input_norm = InputNormalize().to(weight.device) if enabled else nn.Identity()
+        return self
+
+    def fold_input_normalization(self):
+        # Inference only: afterwards conv_input holds the folded weights and the front-end is a dtype cast.
+        if isinstance(self.input_norm, InputNormalize):
+            self.input_norm.fold_into(self.conv_input.conv2d, shift=True)
+        return self
+
+    def forward(self, x, features=True):
+        # features=False returns only the dehazed image, so the encoder features are not kept alive for
+        # the distillation loss.
+        x = self.input_norm(x)
         res1x = self.conv_input(x)
         res1x_1, res1x_2 = res1x.split([(res1x.size()[1] // 2), (res1x.size()[1] // 2)], dim=1)
         feature_mem = [res1x_1]
@@ -395,11 +472,9 @@ class Student_x(nn.Module):
         res16x_1 = self.fusion4(res16x_1, feature_mem)
         res16x_2 = self.conv4(res16x_2)
         res16x = torch.cat((res16x_1, res16x_2), dim=1)
+        del feature_mem, res1x, res1x_1, res1x_2
 
-        res2xx = res2x
-        res4xx = res4x
-        res8xx = res8x
-        res16xx = res16x
+        feats = [res2x, res4x, res8x, res16x] if features else None
 
         res_dehaze = res16x
         in_ft = res16x * 2
@@ -407,8 +482,7 @@ class Student_x(nn.Module):
         res16x_1, res16x_2 = res16x.split([(res16x.size()[1] // 2), (res16x.size()[1] // 2)], dim=1)
         feature_mem_up = [res16x_1]
 
-        res16x = self.convd16x(res16x)
-        res16x = F.interpolate(res16x, res8x.size()[2:], mode='bilinear')
+        res16x = self.convd16x(res16x, res8x.size()[2:])
         res8x = torch.add(res16x, res8x)
         res8x = self.dense_4(res8x) + res8x - res16x
         res8x_1, res8x_2 = res8x.split([(res8x.size()[1] // 2), (res8x.size()[1] // 2)], dim=1)
@@ -417,8 +491,7 @@ class Student_x(nn.Module):
         feature_mem_up.append(res8x_1)
         res8x = torch.cat((res8x_1, res8x_2), dim=1)
 
-        res8x = self.convd8x(res8x)
-        res8x = F.interpolate(res8x, res4x.size()[2:], mode='bilinear')
+        res8x = self.convd8x(res8x, res4x.size()[2:])
         res4x = torch.add(res8x, res4x)
         res4x = self.dense_3(res4x) + res4x - res8x
         res4x_1, res4x_2 = res4x.split([(res4x.size()[1] // 2), (res4x.size()[1] // 2)], dim=1)
@@ -427,8 +500,7 @@ class Student_x(nn.Module):
         feature_mem_up.append(res4x_1)
         res4x = torch.cat((res4x_1, res4x_2), dim=1)
 
-        res4x = self.convd4x(res4x)
-        res4x = F.interpolate(res4x, res2x.size()[2:], mode='bilinear')
+        res4x = self.convd4x(res4x, res2x.size()[2:])
         res2x = torch.add(res4x, res2x)
 
         res2x = self.dense_2(res2x) + res2x - res4x
@@ -438,8 +510,7 @@ class Student_x(nn.Module):
 
         feature_mem_up.append(res2x_1)
         res2x = torch.cat((res2x_1, res2x_2), dim=1)
-        res2x = self.convd2x(res2x)
-        res2x = F.interpolate(res2x, x.size()[2:], mode='bilinear')
+        res2x = self.convd2x(res2x, x.size()[2:])
         x = torch.add(res2x, x)
         x = self.dense_1(x) + x - res2x
         x_1, x_2 = x.split([(x.size()[1] // 2), (x.size()[1] // 2)], dim=1)
@@ -449,7 +520,9 @@ class Student_x(nn.Module):
 
         x = self.conv_output(x)
 
-        return x, [res2xx, res4xx, res8xx, res16xx]
+        if not features:
+            return x
+        return x, feats
 
 
 if __name__ == "__main__":
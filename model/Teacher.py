@@ -1,10 +1,54 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from einops.layers.torch import Rearrange
+from .input_norm import InputNormalize
+import functools
 import math
 
 
+def fuse_conv_bn(conv, bn):
+    # Folds an inference-mode BatchNorm2d into the preceding conv: y = (conv(x) - mean) / std * gamma + beta.
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride, conv.padding,
+                      conv.dilation, conv.groups, bias=True).to(device=conv.weight.device, dtype=conv.weight.dtype)
+    fused.weight.data.copy_(conv.weight.detach() * scale.detach().reshape(-1, 1, 1, 1))
+    fused.bias.data.copy_(((bias - bn.running_mean) * scale + bn.bias).detach())
+    return fused
+
+
+def checkpoint_module(module, x):
+    # Activation checkpointing: only the input of the module is kept and its forward runs again during backward.
+    # In train mode the recomputed forward would update the BatchNorm running statistics a second time, so the
+    # recomputation runs with momentum 0 (outputs use batch statistics either way; num_batches_tracked is still
+    # incremented twice, which only matters for momentum=None).
+    calls = []
+
+    def run(x):
+        bns = [m for m in module.modules() if isinstance(m, nn.BatchNorm2d)] if calls else []
+        calls.append(1)
+        momenta = [bn.momentum for bn in bns]
+        for bn in bns:
+            bn.momentum = 0.0
+        try:
+            return module(x)
+        finally:
+            for bn, momentum in zip(bns, momenta):
+                bn.momentum = momentum
+
+    return checkpoint(run, x, use_reentrant=False)
+
+
+def sequential_forward(layers, x, use_checkpoint):
+    if not (use_checkpoint and torch.is_grad_enabled()):
+        return layers(x)
+    for layer in layers:
+        x = checkpoint_module(layer, x)
+    return x
+
+
 class Pre_Res2Net(nn.Module):
     def __init__(self, block, layers, baseWidth=26, scale=4, num_classes=1000):
         self.inplanes = 64
@@ -118,6 +162,16 @@ class Bottle2neck(nn.Module):
         self.scale = scale
         self.width = width
 
+    def switch_to_deploy(self):
+        self.conv1 = fuse_conv_bn(self.conv1, self.bn1)
+        self.bn1 = nn.Identity()
+        self.convs = nn.ModuleList([fuse_conv_bn(conv, bn) for conv, bn in zip(self.convs, self.bns)])
+        self.bns = nn.ModuleList([nn.Identity() for _ in range(self.nums)])
+        self.conv3 = fuse_conv_bn(self.conv3, self.bn3)
+        self.bn3 = nn.Identity()
+        if self.downsample is not None:
+            self.downsample = nn.Sequential(self.downsample[0], fuse_conv_bn(self.downsample[1], self.downsample[2]))
+
     def forward(self, x):
         residual = x
 
@@ -161,6 +215,7 @@ class Res2Net(nn.Module):
         super(Res2Net, self).__init__()
         self.baseWidth = baseWidth
         self.scale = scale
+        self.checkpoint = False
         self.conv1 = nn.Sequential(
             nn.Conv2d(3, 32, 3, 2, 1, bias=False),
             nn.BatchNorm2d(32),
@@ -204,6 +259,20 @@ class Res2Net(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def switch_to_deploy(self):
+        stem = self.conv1
+        self.conv1 = nn.Sequential(
+            fuse_conv_bn(stem[0], stem[1]),
+            nn.ReLU(inplace=True),
+            fuse_conv_bn(stem[3], stem[4]),
+            nn.ReLU(inplace=True),
+            fuse_conv_bn(stem[6], self.bn1)
+        )
+        self.bn1 = nn.Identity()
+        for m in self.modules():
+            if isinstance(m, Bottle2neck):
+                m.switch_to_deploy()
+
     def forward(self, x):
 
         x = self.conv1(x)
@@ -213,9 +282,9 @@ class Res2Net(nn.Module):
         x_layer0 = x
         x = self.maxpool(x)
 
-        x_layer1 = self.layer1(x)
-        x_layer2 = self.layer2(x_layer1)
-        x_layer3 = self.layer3(x_layer2)  # x16
+        x_layer1 = sequential_forward(self.layer1, x, self.checkpoint)
+        x_layer2 = sequential_forward(self.layer2, x_layer1, self.checkpoint)
+        x_layer3 = sequential_forward(self.layer3, x_layer2, self.checkpoint)  # x16
         # x_layer3: torch.Size([1, 1024, 16, 16])
         # x_layer2: torch.Size([1, 512, 32, 32])
         # x_layer1: torch.Size([1, 256, 64, 64])
@@ -326,6 +395,8 @@ class Decoder_MDCBlock1(torch.nn.Module):
                     len(ft_l_list) - i - 1]
 
         if self.mode == 'iter2':
+            # Each chain starts from the fusion result of the previous one, so unlike iter1/iter4 nothing can be
+            # shared between chains: see benchmark/mdc.py for the cost of this mode.
             ft_fusion = ft_h
             for i in range(len(ft_l_list)):
                 ft = ft_fusion
@@ -350,12 +421,14 @@ class Decoder_MDCBlock1(torch.nn.Module):
                 ft_fusion = ft_fusion + ft
 
         if self.mode == 'iter4':
+            # Every chain starts from ft_h, so the down-sampled features of the shorter chains are prefixes
+            # of the longest one and are computed once.
+            ft_downs = [ft_h]
+            for j in range(self.num_ft):
+                ft_downs.append(self.down_convs[j](ft_downs[-1]))
             ft_fusion = ft_h
             for i in range(len(ft_l_list)):
-                ft = ft_h
-                for j in range(self.num_ft - i):
-                    ft = self.down_convs[j](ft)
-                ft = ft - ft_l_list[i]
+                ft = ft_downs[self.num_ft - i] - ft_l_list[i]
                 for j in range(self.num_ft - i):
                     ft = self.up_convs[self.num_ft - i - j - 1](ft)
                 ft_fusion = ft_fusion + ft
@@ -387,9 +460,25 @@ class RDB(nn.Module):
             nChannels_ += growthRate
         self.dense_layers = nn.Sequential(*modules)
         self.conv_1x1 = nn.Conv2d(nChannels_, nChannels, kernel_size=1, padding=0, bias=False)
+        self.preallocate = True
+
+    def dense_forward(self, x):
+        # Every dense layer writes its growth channels into a slice of one buffer instead of concatenating
+        # the whole growing feature map. The in-place writes are only valid when autograd is off.
+        out = x.new_empty(x.shape[0], self.conv_1x1.in_channels, x.shape[2], x.shape[3])
+        channels = x.shape[1]
+        out[:, :channels] = x
+        for layer in self.dense_layers:
+            growth = layer.conv.out_channels
+            out[:, channels:channels + growth] = F.relu(layer.conv(out[:, :channels]), inplace=True)
+            channels += growth
+        return out
 
     def forward(self, x):
-        out = self.dense_layers(x)
+        if self.preallocate and not torch.is_grad_enabled():
+            out = self.dense_forward(x)
+        else:
+            out = self.dense_layers(x)
         out = self.conv_1x1(out) * self.scale
         out = out + x
         return out
@@ -408,19 +497,56 @@ class ConvLayer(nn.Module):
         return out
 
 
+@functools.lru_cache(maxsize=64)
+def resample_taps(size_in, size_mid, size_out, device):
+    # Per-axis taps of nearest-exact (size_in -> size_mid) followed by bilinear (size_mid -> size_out). The
+    # weights are obtained by resampling an identity matrix with F.interpolate itself, so the source indices
+    # and lambdas are exactly the ones of the two-step resample. Bounded, as Eval.py, Serve.py and tiled
+    # inference see arbitrary input sizes.
+    eye = torch.eye(size_in, device=device).view(1, 1, size_in, size_in)
+    eye = F.interpolate(eye, size=(size_mid, size_in), mode="nearest-exact")
+    matrix = F.interpolate(eye, size=(size_out, size_in), mode='bilinear')[0, 0]
+    weights, index = matrix.topk(int((matrix != 0).sum(1).max()), dim=1)
+    return weights, index
+
+
+def resample(x, size_mid, size_out):
+    for dim in (2, 3):
+        weights, index = resample_taps(x.shape[dim], size_mid[dim - 2], size_out[dim - 2], x.device)
+        shape = [1, 1, 1, 1]
+        shape[dim] = -1
+        out = 0
+        for k in range(index.shape[1]):
+            out = out + x.index_select(dim, index[:, k]) * weights[:, k].view(shape).to(x.dtype)
+        x = out
+    return x
+
+
 class UpsampleConvLayer(torch.nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, stride):
         super(UpsampleConvLayer, self).__init__()
         self.stride = stride
         self.kernel_size = kernel_size
         self.conv2d = nn.Conv2d(in_channels, out_channels, kernel_size=1, stride=1)
+        self.fused = True
 
-    def forward(self, x):
+    def forward(self, x, size=None):
+        # With size, the output is also bilinearly resized to it, as the decoders do to match the skip connection.
         h = (x.shape[2] - 1) * self.stride + self.kernel_size
         w = (x.shape[3] - 1) * self.stride + self.kernel_size
-        x = F.interpolate(x, size=(h, w), mode="nearest-exact")
+        if not self.fused:
+            x = F.interpolate(x, size=(h, w), mode="nearest-exact")
+            out = self.conv2d(x)
+            if size is not None:
+                out = F.interpolate(out, size, mode='bilinear')
+            return out
+
+        # The 1x1 conv commutes with nearest upsampling, so it runs at the input resolution, and the nearest and
+        # bilinear resamples are merged into a single pass over precomputed taps.
         out = self.conv2d(x)
-        return out
+        if size is None:
+            return F.interpolate(out, size=(h, w), mode="nearest-exact")
+        return resample(out, (h, w), tuple(size))
 
 
 class ResidualBlock(torch.nn.Module):
@@ -502,65 +628,110 @@ class Teacher(nn.Module):
         self.H2 = nn.Conv2d(128, 64, kernel_size=1)
         self.H3 = nn.Conv2d(64, 32, kernel_size=1)
         self.H4 = nn.Conv2d(32, 16, kernel_size=1)
-
-    def forward(self, x):
+        self.input_norm = nn.Identity()
+        self.deploy = False
+        self.checkpoint = set()
+
+    def set_checkpoint(self, segments):
+        # Trades compute for activation memory during training: 'encoder' checkpoints every Res2Net block,
+        # 'dehaze' every ResidualBlock of the dehaze stack and 'decoder' every dense_* stage.
+        unknown = set(segments) - {'encoder', 'dehaze', 'decoder'}
+        if unknown:
+            raise ValueError(f'unknown checkpoint segments: {sorted(unknown)}')
+        self.checkpoint = set(segments)
+        self.encoder.checkpoint = 'encoder' in self.checkpoint
+        return self
+
+    def set_input_normalization(self, enabled=True):
+        # enabled: the model takes uint8 (0-255) images and normalizes them itself instead of the data loader.
+        weight = self.conv_output.conv2d.weight
+        self.input_norm = InputNormalize().to(weight.device) if enabled else nn.Identity()
+        return self
+
+    def fold_input_normalization(self):
+        # Inference only: the scale moves into the first stem conv. That conv pads with zeros, so the front-end
+        # keeps subtracting the mean color.
+        if isinstance(self.input_norm, InputNormalize):
+            self.input_norm.fold_into(self.encoder.conv1[0], shift=False)
+        return self
+
+    def decoder_stage(self, stage, x):
+        if 'decoder' in self.checkpoint and torch.is_grad_enabled():
+            return checkpoint_module(stage, x)
+        return stage(x)
+
+    def switch_to_deploy(self, verify=True, atol=1e-3):
+        # Folds every BatchNorm of the Res2Net encoder into its conv using the running statistics, so the
+        # folded model is only meant for inference (frozen teacher during KD, evaluation).
+        if self.deploy:
+            return self
+        self.eval()
+        if verify:
+            x = torch.randn(1, 3, 64, 64, device=self.conv_output.conv2d.weight.device)
+            with torch.no_grad():
+                ref = self(x, features=False)
+        self.encoder.switch_to_deploy()
+        self.fold_input_normalization()
+        self.deploy = True
+        if verify:
+            with torch.no_grad():
+                err = (self(x, features=False) - ref).abs().max().item()
+            if err > atol * max(1.0, ref.abs().max().item()):
+                raise RuntimeError(f'BatchNorm-folded Teacher differs from the original model by {err}')
+        return self
+
+    def forward(self, x, features=True):
+        # features=False returns only the dehazed image and skips the H1-H4 projections, which only the
+        # distillation loss uses.
+        x = self.input_norm(x)
         ini = x
         x_layer0, x_layer1, x_layer2, x_layer3 = self.encoder(x)
         res16x = self.CRA1(x_layer0)
         res8x = self.CRA2(x_layer1)
         res4x = self.CRA3(x_layer2)
         res2x = self.CRA4(x_layer3)
+        del x_layer0, x_layer1, x_layer2, x_layer3
 
-        res16xx = self.H1(res16x)
-        res8xx = self.H2(res8x)
-        res4xx = self.H3(res4x)
-        res2xx = self.H4(res2x)
+        if features:
+            feats = [self.H4(res2x), self.H3(res4x), self.H2(res8x), self.H1(res16x)]
 
         res_dehaze = res16x
         in_ft = res16x * 2
-        res16x = self.dehaze(in_ft) + in_ft - res_dehaze
+        res16x = sequential_forward(self.dehaze, in_ft, 'dehaze' in self.checkpoint) + in_ft - res_dehaze
         res16x_1, res16x_2 = res16x.split([(res16x.size()[1] // 2), (res16x.size()[1] // 2)], dim=1)
         feature_mem_up = [res16x_1]
 
-        res16x = self.convd16x(res16x)
-
-        res16x = F.interpolate(res16x, res8x.size()[2:], mode='bilinear')
+        res16x = self.convd16x(res16x, res8x.size()[2:])
         res8x = torch.add(res16x, res8x)
-        res8x = self.dense_4(res8x) + res8x - res16x
+        res8x = self.decoder_stage(self.dense_4, res8x) + res8x - res16x
         res8x_1, res8x_2 = res8x.split([(res8x.size()[1] // 2), (res8x.size()[1] // 2)], dim=1)
         res8x_1 = self.fusion_4(res8x_1, feature_mem_up)
         res8x_2 = self.conv_4(res8x_2)
         feature_mem_up.append(res8x_1)
         res8x = torch.cat((res8x_1, res8x_2), dim=1)
 
-        res8x = self.convd8x(res8x)
-
-        res8x = F.interpolate(res8x, res4x.size()[2:], mode='bilinear')
+        res8x = self.convd8x(res8x, res4x.size()[2:])
         res4x = torch.add(res8x, res4x)
-        res4x = self.dense_3(res4x) + res4x - res8x
+        res4x = self.decoder_stage(self.dense_3, res4x) + res4x - res8x
         res4x_1, res4x_2 = res4x.split([(res4x.size()[1] // 2), (res4x.size()[1] // 2)], dim=1)
         res4x_1 = self.fusion_3(res4x_1, feature_mem_up)
         res4x_2 = self.conv_3(res4x_2)
         feature_mem_up.append(res4x_1)
         res4x = torch.cat((res4x_1, res4x_2), dim=1)
 
-        res4x = self.convd4x(res4x)
-
-        res4x = F.interpolate(res4x, res2x.size()[2:], mode='bilinear')
+        res4x = self.convd4x(res4x, res2x.size()[2:])
         res2x = torch.add(res4x, res2x)
 
-        res2x = self.dense_2(res2x) + res2x - res4x
+        res2x = self.decoder_stage(self.dense_2, res2x) + res2x - res4x
         res2x_1, res2x_2 = res2x.split([(res2x.size()[1] // 2), (res2x.size()[1] // 2)], dim=1)
         res2x_1 = self.fusion_2(res2x_1, feature_mem_up)
         res2x_2 = self.conv_2(res2x_2)
 
         feature_mem_up.append(res2x_1)
         res2x = torch.cat((res2x_1, res2x_2), dim=1)
-        res2x = self.convd2x(res2x)
-
-        res2x = F.interpolate(res2x, ini.size()[2:], mode='bilinear')
+        res2x = self.convd2x(res2x, ini.size()[2:])
         x = torch.add(res2x, res2x)
-        x = self.dense_1(x) + x - res2x
+        x = self.decoder_stage(self.dense_1, x) + x - res2x
         x_1, x_2 = x.split([(x.size()[1] // 2), (x.size()[1] // 2)], dim=1)
         x_1 = self.fusion_1(x_1, feature_mem_up)
 
@@ -569,7 +740,9 @@ class Teacher(nn.Module):
 
         x = self.conv_output(x)
 
-        return x, [res2xx, res4xx, res8xx, res16xx]
+        if not features:
+            return x
+        return x, feats
 
 
 if __name__ == "__main__":
@@ -0,0 +1,35 @@
+import torch
+import torch.nn as nn
+from data.data_loader import CLIP_MEAN, CLIP_STD
+
+
+class InputNormalize(nn.Module):
+    # Front-end for uint8 (0-255) images: the CLIP normalization of data.preprocess_feature, written as
+    # scale * (x - center) so that fold_into can move it into the first conv for deployment.
+    def __init__(self, mean=CLIP_MEAN, std=CLIP_STD):
+        super(InputNormalize, self).__init__()
+        # Not persistent: checkpoints load the same with and without the front-end.
+        self.register_buffer('center', torch.tensor(mean).view(1, 3, 1, 1) * 255, persistent=False)
+        self.register_buffer('scale', 1 / (torch.tensor(std).view(1, 3, 1, 1) * 255), persistent=False)
+        self.centered = True
+        self.scaled = True
+
+    def fold_into(self, conv, shift):
+        # The per-channel scale always moves into the conv weights. The centering only moves into the bias when
+        # shift is set, which is exact for a reflection-padded conv only: with zero padding the input has to stay
+        # centered so that the padded zeros still stand for the mean color.
+        with torch.no_grad():
+            if self.scaled:
+                conv.weight.mul_(self.scale.view(1, -1, 1, 1))
+                self.scaled = False
+            if shift and self.centered:
+                conv.bias.sub_((conv.weight * self.center.view(1, -1, 1, 1)).sum((1, 2, 3)))
+                self.centered = False
+
+    def forward(self, x):
+        x = x.to(self.center.dtype)
+        if self.centered:
+            x = x - self.center
+        if self.scaled:
+            x = x * self.scale
+        return x
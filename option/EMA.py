@@ -12,9 +12,18 @@ parser.add_argument('--finer_eval_step', type=int, default=20000)
 parser.add_argument('--start_lr', default=0.0000001, type=float, help='start learning rate')
 parser.add_argument('--end_lr', default=0.00000001, type=float, help='end learning rate')
 parser.add_argument('--no_lr_sche', action='store_true', help='no lr cos schedule')
+parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                    help='autocast precision of the forward passes, fp16 also uses a GradScaler')
+parser.add_argument('--test_batch_size', type=int, default=1, help='images per batch during evaluation')
+parser.add_argument('--async_eval', action='store_true', help='evaluate in a separate process without pausing training')
+parser.add_argument('--batch_aug', action='store_true',
+                    help='loader workers return uint8 crops, augmentation and normalization run on the batch')
 
 parser.add_argument('--w_loss_L1_r', default=1, type=float, help='weight of loss L1_r')
 parser.add_argument('--w_loss_Clip', default=0.5, type=float, help='weight of loss Clip')
+parser.add_argument('--teacher_worker', action='store_true', help='run the teacher in a separate process')
+parser.add_argument('--teacher_queue', type=int, default=4, help='batches prepared ahead by the teacher worker')
+parser.add_argument('--teacher_threads', type=int, default=0, help='torch threads of the teacher worker, 0 keeps the default')
 
 
 parser.add_argument('--exp_dir', type=str, default='./experiment')
@@ -25,6 +34,8 @@ parser.add_argument('--dataset', type=str, default='EMA')
 
 opt = parser.parse_args()
 opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+if opt.amp == 'fp16' and opt.device != 'cuda':
+    parser.error('--amp fp16 needs a CUDA device, use --amp bf16 on CPU')
 
 dataset_dir = os.path.join(opt.exp_dir, opt.dataset)
 model_dir = os.path.join(dataset_dir, opt.model_name)
@@ -0,0 +1,16 @@
+import argparse
+import torch
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--device', type=str, default='Automatic detection')
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8000)
+parser.add_argument('--model', type=str, default='Student_x', choices=['Teacher', 'Student', 'Student_x'])
+parser.add_argument('--model_path', type=str, default='./model/EMA_model/EMA_r.pth')
+parser.add_argument('--max_batch', type=int, default=8, help='max images of the same padded size per forward pass')
+parser.add_argument('--max_wait_ms', type=float, default=10, help='max time a request waits for its batch to fill')
+parser.add_argument('--io_workers', type=int, default=4, help='threads decoding requests and encoding responses')
+
+opt = parser.parse_args()
+opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
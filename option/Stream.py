@@ -0,0 +1,13 @@
+import argparse
+import torch
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--device', type=str, default='Automatic detection')
+parser.add_argument('--width', type=int, required=True, help='frame width in pixels')
+parser.add_argument('--height', type=int, required=True, help='frame height in pixels')
+parser.add_argument('--model', type=str, default='Student_x', choices=['Teacher', 'Student', 'Student_x'])
+parser.add_argument('--model_path', type=str, default='./model/EMA_model/EMA_r.pth')
+
+opt = parser.parse_args()
+opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -12,10 +12,25 @@ parser.add_argument('--finer_eval_step', type=int, default=100000)
 parser.add_argument('--start_lr', default=0.0001, type=float, help='start learning rate')
 parser.add_argument('--end_lr', default=0.000001, type=float, help='end learning rate')
 parser.add_argument('--no_lr_sche', action='store_true', help='no lr cos schedule')
+parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                    help='autocast precision of the forward passes, fp16 also uses a GradScaler')
+parser.add_argument('--test_batch_size', type=int, default=1, help='images per batch during evaluation')
+parser.add_argument('--async_eval', action='store_true', help='evaluate in a separate process without pausing training')
+parser.add_argument('--batch_aug', action='store_true',
+                    help='loader workers return uint8 crops, augmentation and normalization run on the batch')
+parser.add_argument('--state_every', type=int, default=1000,
+                    help='steps between resumable training states (saved_model/last.pth)')
+parser.add_argument('--resume', type=str, default='', help='training state (last.pth) to continue from')
 parser.add_argument('--w_loss_L1', default=0.8, type=float, help='weight of loss L1')
 parser.add_argument('--w_loss_SSIM', default=0.2, type=float, help='weight of loss SSIM')
 parser.add_argument('--w_loss_Cr', default=0.05, type=float, help='weight of loss Cr')
+parser.add_argument('--checkpoint', type=str, nargs='*', default=[], choices=['encoder', 'dehaze', 'decoder'],
+                    help='activation checkpointing of the given Teacher segments, trades step time for memory')
 
+parser.add_argument('--data_index', type=str, default='',
+                    help='index built by data.index, replaces the listing and pairing of the training images')
+parser.add_argument('--packed', type=str, default='',
+                    help='training set packed by data.packed, read without decoding the images')
 parser.add_argument('--exp_dir', type=str, default='./experiment')
 parser.add_argument('--model_name', type=str, default='THaze')
 parser.add_argument('--saved_model_dir', type=str, default='saved_model')
@@ -24,6 +39,8 @@ parser.add_argument('--dataset', type=str, default='Teacher')
 
 opt = parser.parse_args()
 opt.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+if opt.amp == 'fp16' and opt.device != 'cuda':
+    parser.error('--amp fp16 needs a CUDA device, use --amp bf16 on CPU')
 
 dataset_dir = os.path.join(opt.exp_dir, opt.dataset)
 model_dir = os.path.join(dataset_dir, opt.model_name)
@@ -38,6 +55,10 @@ if not os.path.exists(model_dir):
     opt.saved_data_dir = os.path.join(model_dir, 'saved_data')
     os.mkdir(opt.saved_model_dir)
     os.mkdir(opt.saved_data_dir)
+elif opt.resume:
+    # Continue writing into the run being resumed.
+    opt.saved_model_dir = os.path.join(model_dir, 'saved_model')
+    opt.saved_data_dir = os.path.join(model_dir, 'saved_data')
 
 with open(os.path.join(model_dir, 'args.txt'), 'w') as f:
     json.dump(opt.__dict__, f, indent=2)
@@ -0,0 +1,2 @@
+from .checkpoint import CheckpointWriter, snapshot_state_dict, atomic_save, rng_state, set_rng_state, \
+    load_training_state
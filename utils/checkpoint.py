@@ -0,0 +1,118 @@
+import os
+import queue
+import random
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def snapshot_state_dict(state_dict):
+    # CPU copy of a state dict without the DataParallel 'module.' prefix, safe to keep while training goes on.
+    return OrderedDict((k.replace('module.', '', 1) if k.startswith('module.') else k, v.detach().to('cpu', copy=True))
+                       for k, v in state_dict.items())
+
+
+def snapshot(obj):
+    # Same for a whole training state: tensors are copied to CPU, containers are copied so later appends don't race
+    # with the writer.
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def load_training_state(path):
+    # Written by CheckpointWriter.save_state; holds numpy and python RNG states, so it is not a weights-only file.
+    return torch.load(path, map_location='cpu', weights_only=False)
+
+
+def atomic_save(obj, path):
+    tmp = f'{path}.tmp'
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+def link_or_save(src, obj, path):
+    # Another name for an already written checkpoint: a hard link when the file system allows it.
+    tmp = f'{path}.tmp'
+    try:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(src, tmp)
+    except OSError:
+        torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+class CheckpointWriter(object):
+    # Writes checkpoints from a background thread. save() only pays for the CPU snapshot; the file is written to
+    # <path>.tmp and renamed, so a checkpoint on disk is always complete. All paths of one save() get the same
+    # file (best.pth and <epoch>.pth of one eval point are the same weights). Every queued save holds a CPU copy of
+    # the weights (and save_state the optimizer state and histories), so at most `depth` wait and save() blocks
+    # when the disk falls behind.
+    def __init__(self, depth=2):
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is not None:
+                    state_dict, paths = item
+                    atomic_save(state_dict, paths[0])
+                    for path in paths[1:]:
+                        link_or_save(paths[0], state_dict, path)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+            if item is None:
+                break
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('checkpoint write failed') from error
+
+    def save(self, state_dict, *paths):
+        self._check()
+        self.queue.put((snapshot_state_dict(state_dict), paths))
+
+    def save_state(self, path, state_dict, **state):
+        # Resumable training state: the model weights as in save() under 'model', the rest (optimizer, step,
+        # histories, RNG states) as given.
+        self._check()
+        state = snapshot(state)
+        state['model'] = snapshot_state_dict(state_dict)
+        self.queue.put((state, (path,)))
+
+    def flush(self):
+        self.queue.join()
+        self._check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._check()